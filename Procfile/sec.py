@@ -4,6 +4,7 @@ from gtts import gTTS
 import os
 import requests
 import subprocess
+import sys
 
 st.set_page_config(page_title="AI News Reader", layout="centered")
 st.title("🗞️ AI News Reader (Free Version)")
@@ -16,6 +17,7 @@ face_img = st.file_uploader("🖼️ Upload a face image (JPG/PNG)", type=["jpg"
 checkpoint_path = "Wav2Lip/checkpoints/wav2lip_gan.pth"
 video_path = "results/result_voice.mp4"
 model_url = "https://huggingface.co/spaces/akhilpamidi/wav2lip-model/resolve/main/wav2lip_gan.pth"
+render_socket = os.getenv("WAV2LIP_SOCKET", "/tmp/wav2lip.sock")
 
 # Automatically download model if missing
 if not os.path.isfile(checkpoint_path):
@@ -47,23 +49,40 @@ if st.button("🎬 Generate Video"):
 
             os.makedirs("results", exist_ok=True)
 
-            # Run Wav2Lip using subprocess for better error capture
-            command = [
-                "python3", "Wav2Lip/inference.py",
-                "--checkpoint_path", checkpoint_path,
-                "--face", "input_face.jpg",
-                "--audio", "news_audio.mp3"
-            ]
-            result = subprocess.run(command, capture_output=True, text=True)
+            # Prefer the resident render server (Wav2Lip/render_server.py), which
+            # keeps the models loaded; fall back to a one-off inference.py run.
+            if os.path.exists(render_socket):
+                # streamlit only puts this script's directory on sys.path
+                repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+                if repo_root not in sys.path:
+                    sys.path.insert(0, repo_root)
+                from Wav2Lip.render_server import render
 
-            if result.returncode == 0 and os.path.exists(video_path):
+                response = render({
+                    "face": os.path.abspath("input_face.jpg"),
+                    "audio": os.path.abspath("news_audio.mp3"),
+                    "outfile": os.path.abspath(video_path),
+                }, render_socket)
+                ok, logs = response["ok"], response.get("error", "")
+            else:
+                # Run Wav2Lip using subprocess for better error capture
+                command = [
+                    "python3", "Wav2Lip/inference.py",
+                    "--checkpoint_path", checkpoint_path,
+                    "--face", "input_face.jpg",
+                    "--audio", "news_audio.mp3"
+                ]
+                result = subprocess.run(command, capture_output=True, text=True)
+                ok, logs = result.returncode == 0, result.stderr
+
+            if ok and os.path.exists(video_path):
                 st.success("✅ Video generated successfully!")
                 st.video(video_path)
                 with open(video_path, "rb") as f:
                     st.download_button("⬇️ Download Video", f, file_name="AI_News.mp4", mime="video/mp4")
             else:
                 st.error("❌ Video generation failed.")
-                st.text("🔍 Logs:\n" + result.stderr)
+                st.text("🔍 Logs:\n" + logs)
 
         except Exception as e:
             st.error(f"❌ Error: {str(e)}")
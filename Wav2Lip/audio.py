@@ -4,10 +4,72 @@ import numpy as np
 # import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
+import subprocess
+from math import gcd
 from hparams import hparams as hp
 
 def load_wav(path, sr):
-    return librosa.core.load(path, sr=sr)[0]
+    """Loads any audio file as mono float32 samples at ``sr`` Hz, in memory.
+
+    PCM .wav files are read directly and only resampled (polyphase) if their rate
+    differs from ``sr``; everything else is decoded and resampled by an ffmpeg
+    pipe. librosa is only used as a fallback when neither works.
+    """
+    if path.lower().endswith('.wav'):
+        try:
+            return _load_pcm_wav(path, sr)
+        except ValueError:
+            pass
+    try:
+        return _decode_with_ffmpeg(path, sr)
+    except (OSError, RuntimeError):
+        return librosa.core.load(path, sr=sr)[0]
+
+def _load_pcm_wav(path, sr):
+    file_sr, wav = wavfile.read(path, mmap=True)
+    if wav.dtype == np.uint8:
+        wav = (wav.astype(np.float32) - 128.) / 128.
+    elif np.issubdtype(wav.dtype, np.integer):
+        wav = wav.astype(np.float32) / float(np.iinfo(wav.dtype).max + 1)
+    else:
+        wav = wav.astype(np.float32)
+
+    if wav.ndim > 1:
+        wav = wav.mean(axis=1)
+    if file_sr != sr:
+        g = gcd(int(file_sr), int(sr))
+        wav = signal.resample_poly(wav, sr // g, file_sr // g).astype(np.float32)
+    return wav
+
+def _decode_with_ffmpeg(path, sr):
+    # Keep the source's channels and average them here, like librosa (and therefore
+    # training) did: ffmpeg's own -ac downmix and upmix both change the level.
+    # The wav header written to the pipe carries the channel count.
+    command = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', path,
+               '-vn', '-ar', str(sr), '-acodec', 'pcm_f32le', '-f', 'wav', '-']
+    proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError('ffmpeg could not decode {}: {}'.format(path, proc.stderr.decode('utf-8', 'replace')))
+    channels, data = _parse_piped_wav(proc.stdout)
+    wav = np.frombuffer(data, dtype=np.float32, count=len(data) // (4 * channels) * channels)
+    return wav.reshape(-1, channels).mean(axis=1)
+
+def _parse_piped_wav(buf):
+    """Channel count and sample bytes of a wav file written to a pipe, whose RIFF
+    and data sizes are left unset (the data runs to the end)."""
+    if buf[:4] != b'RIFF' or buf[8:12] != b'WAVE':
+        raise RuntimeError('ffmpeg did not write a wav stream')
+    pos, channels = 12, None
+    while pos + 8 <= len(buf):
+        chunk, size = buf[pos:pos + 4], int.from_bytes(buf[pos + 4:pos + 8], 'little')
+        if chunk == b'fmt ':
+            channels = int.from_bytes(buf[pos + 10:pos + 12], 'little')
+        elif chunk == b'data':
+            if not channels:
+                break
+            return channels, buf[pos + 8:]
+        pos += 8 + size + (size & 1)
+    raise RuntimeError('ffmpeg wrote a wav stream without audio')
 
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
@@ -0,0 +1,179 @@
+"""Merges Wav2Lip batches from concurrent jobs into full batches.
+
+Each render submits its (mel, face) batches and gets a future for the matching
+predictions. A single thread runs the model on up to ``max_batch`` rows at a
+time, taken in arrival order across jobs (a job's batch may be split between two
+model calls), and waits at most ``max_wait`` seconds after the oldest pending
+row arrived for a batch to fill up.
+
+render_server.py runs a scheduler in its own process with ``serve_batches`` and
+its workers reach it through ``SchedulerClient``, which can be called like the
+model it stands for.
+"""
+import collections, threading, time
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+import torch
+
+class SchedulerError(Exception):
+	"""A batch failed in the scheduler process."""
+
+class _Request:
+	def __init__(self, mel_batch, img_batch):
+		self.mel_batch = mel_batch
+		self.img_batch = img_batch
+		self.future = Future()
+		self.arrived = time.monotonic()
+		self.taken = 0
+		self.outputs = {}
+
+	def __len__(self):
+		return len(self.img_batch)
+
+class BatchScheduler:
+	def __init__(self, model, max_batch=128, max_wait=0.02):
+		self.model = model
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.pending = collections.deque()
+		self.cond = threading.Condition()
+		self.batches = 0
+		self.rows = 0
+		threading.Thread(target=self._run, name='batch-scheduler', daemon=True).start()
+
+	@property
+	def queue_depth(self):
+		"""Rows submitted but not yet handed to the model."""
+		with self.cond:
+			return sum(len(r) - r.taken for r in self.pending)
+
+	@property
+	def mean_batch_size(self):
+		return self.rows / self.batches if self.batches else 0.
+
+	def submit(self, mel_batch, img_batch):
+		request = _Request(mel_batch, img_batch)
+		with self.cond:
+			self.pending.append(request)
+			self.cond.notify()
+		return request.future
+
+	def __call__(self, mel_batch, img_batch):
+		return self.submit(mel_batch, img_batch).result()
+
+	def _take(self):
+		"""Waits for a batch to fill or for the deadline, then returns its
+		[(request, start, end)] row ranges."""
+		with self.cond:
+			while not self.pending:
+				self.cond.wait()
+			deadline = self.pending[0].arrived + self.max_wait
+			while sum(len(r) - r.taken for r in self.pending) < self.max_batch:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				self.cond.wait(remaining)
+
+			parts, n = [], 0
+			while self.pending and n < self.max_batch:
+				request = self.pending[0]
+				k = min(len(request) - request.taken, self.max_batch - n)
+				parts.append((request, request.taken, request.taken + k))
+				request.taken += k
+				n += k
+				if request.taken == len(request):
+					self.pending.popleft()
+			return parts
+
+	def _run(self):
+		while 1:
+			parts = self._take()
+			try:
+				with torch.no_grad():
+					pred = self.model(torch.cat([r.mel_batch[a:b] for r, a, b in parts]),
+									torch.cat([r.img_batch[a:b] for r, a, b in parts]))
+			except Exception as e:
+				for request, _, _ in parts:
+					if not request.future.done():
+						request.future.set_exception(e)
+				continue
+
+			self.batches += 1
+			self.rows += len(pred)
+			i = 0
+			for request, a, b in parts:
+				request.outputs[a] = pred[i:i + b - a]
+				i += b - a
+				done = sum(len(o) for o in request.outputs.values())
+				if done == len(request) and not request.future.done():
+					request.future.set_result(torch.cat([request.outputs[k] for k in sorted(request.outputs)]))
+
+def _serve_connection(conn, scheduler, device):
+	with conn:
+		while 1:
+			try:
+				message = conn.recv()
+			except EOFError:
+				return
+			try:
+				if message[0] == 'depth':
+					conn.send(('ok', scheduler.queue_depth))
+					continue
+				_, mel_batch, img_batch = message
+				pred = scheduler(torch.from_numpy(mel_batch).to(device), torch.from_numpy(img_batch).to(device))
+				conn.send(('ok', pred.cpu().numpy()))
+			except Exception as e:
+				conn.send(('error', '{}: {}'.format(type(e).__name__, e)))
+
+def serve_batches(model, address, device, max_batch=128, max_wait=0.02):
+	"""Runs a BatchScheduler for ``model`` and serves SchedulerClients connecting
+	on the Unix socket ``address``, one thread per connection. Never returns."""
+	scheduler = BatchScheduler(model, max_batch, max_wait)
+	with Listener(address, family='AF_UNIX') as listener:
+		while 1:
+			conn = listener.accept()
+			threading.Thread(target=_serve_connection, args=(conn, scheduler, device), daemon=True).start()
+
+class SchedulerClient:
+	"""Stands in for the model in a render process: calls are sent to the
+	scheduler process and block until their rows have been run."""
+
+	def __init__(self, address, connect_timeout=30):
+		self.address = address
+		self.connect_timeout = connect_timeout
+		self.conn = None
+		self.lock = threading.Lock()
+
+	def _connect(self):
+		# The scheduler may still be starting (or restarting) when the first job arrives.
+		deadline = time.monotonic() + self.connect_timeout
+		while 1:
+			try:
+				return Client(self.address, family='AF_UNIX')
+			except OSError:
+				if time.monotonic() > deadline:
+					raise
+				time.sleep(0.1)
+
+	def _call(self, message):
+		with self.lock:
+			if self.conn is None:
+				self.conn = self._connect()
+			try:
+				self.conn.send(message)
+				status, result = self.conn.recv()
+			except (OSError, EOFError) as e:
+				self.conn.close()
+				self.conn = None
+				raise SchedulerError('Lost the connection to the batch scheduler: {}'.format(e))
+		if status != 'ok':
+			raise SchedulerError(result)
+		return result
+
+	def __call__(self, mel_batch, img_batch):
+		pred = self._call(('infer', mel_batch.cpu().numpy(), img_batch.cpu().numpy()))
+		return torch.from_numpy(pred).to(img_batch.device)
+
+	@property
+	def queue_depth(self):
+		return self._call(('depth',))
@@ -0,0 +1,96 @@
+import os, json, platform, tempfile
+import torch
+
+# Peak activation memory measured on CPU in fp32, with some headroom.
+S3FD_BYTES_PER_PIXEL = 1024
+WAV2LIP_BYTES_PER_SAMPLE = 12 << 20
+
+def default_profile_path():
+	return os.path.join(os.path.expanduser('~'), '.cache', 'wav2lip', 'batch_sizes.json')
+
+def available_memory(device):
+	"""Free memory in bytes on ``device``, or None if it cannot be determined."""
+	if 'cuda' in device:
+		free, _ = torch.cuda.mem_get_info(torch.device(device))
+		return free
+
+	try:
+		with open('/proc/meminfo') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	try:
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+	except (ValueError, OSError, AttributeError):
+		return None
+
+def machine_profile(device):
+	if 'cuda' in device:
+		props = torch.cuda.get_device_properties(torch.device(device))
+		return '{}:{}MB'.format(props.name, props.total_memory >> 20)
+	try:
+		total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+	except (ValueError, OSError, AttributeError):
+		total = 0
+	return '{}:{}cpu:{}MB'.format(platform.machine(), os.cpu_count(), total >> 20)
+
+class BatchTuner:
+	"""Picks face detection and Wav2Lip batch sizes for this machine.
+
+	The first render on a machine profile estimates batch sizes from the memory
+	budget (a fraction of the currently free memory unless ``budget`` is given)
+	and the frame resolution. Sizes that then ran without running out of memory,
+	including any reduced after a back-off, are stored per profile in a small JSON
+	file and used as-is by later renders.
+	"""
+
+	def __init__(self, device, budget=None, fraction=0.5, path=None, max_batch=256):
+		self.device = device
+		self.path = path or default_profile_path()
+		self.max_batch = max_batch
+		if budget is None:
+			free = available_memory(device)
+			budget = int(free * fraction) if free is not None else None
+		self.budget = budget
+		self.profile = machine_profile(device)
+
+	def _load(self):
+		try:
+			with open(self.path) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	def _estimate(self, item_bytes, default):
+		if self.budget is None:
+			return default
+		return max(1, min(self.max_batch, self.budget // item_bytes))
+
+	def face_det_batch_size(self, frame_shape, default=16):
+		h, w = frame_shape[:2]
+		recorded = self._load().get(self.profile, {}).get('s3fd@{}x{}'.format(h, w))
+		return recorded or self._estimate(h * w * S3FD_BYTES_PER_PIXEL, default)
+
+	def wav2lip_batch_size(self, default=128):
+		recorded = self._load().get(self.profile, {}).get('wav2lip')
+		return recorded or self._estimate(WAV2LIP_BYTES_PER_SAMPLE, default)
+
+	def record(self, name, size):
+		records = self._load()
+		if records.get(self.profile, {}).get(name) == size:
+			return
+		records.setdefault(self.profile, {})[name] = size
+
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(self.path))
+		with os.fdopen(fd, 'w') as f:
+			json.dump(records, f, indent=1, sort_keys=True)
+		os.replace(tmp, self.path)
+
+	def record_face_det(self, frame_shape, size):
+		self.record('s3fd@{}x{}'.format(*frame_shape[:2]), size)
+
+	def record_wav2lip(self, size):
+		self.record('wav2lip', size)
@@ -0,0 +1,61 @@
+"""Checks that audio.load_wav decodes like the old temp.wav path did: ffmpeg
+extracting temp/temp.wav at the source's rate and channels, then librosa.load
+resampling it and averaging the channels. Training used that path, so the level
+of the samples (and thus of the mel spectrogram) has to match it.
+
+Without --audio, a mono and a stereo mp3 are generated with ffmpeg. Only the
+resamplers differ, so the samples must agree to within --tolerance and their RMS
+to within --level_tolerance. Exits with status 1 otherwise.
+
+	python check_audio_decoding.py
+	python check_audio_decoding.py --audio speech.mp3 music.m4a
+"""
+import argparse, os, subprocess, sys, tempfile
+import numpy as np
+import librosa
+
+import audio
+from hparams import hparams as hp
+
+parser = argparse.ArgumentParser(description='Compare audio.load_wav with the temp.wav + librosa path')
+parser.add_argument('--audio', nargs='+', default=None, help='Files to decode (default: generated mp3s)')
+parser.add_argument('--tolerance', type=float, default=1e-2, help='Largest allowed sample difference')
+parser.add_argument('--level_tolerance', type=float, default=0.01, help='Largest allowed relative RMS difference')
+
+def generate(tmpdir):
+	"""A mono and a stereo mp3 of sine tones at 44.1 kHz."""
+	paths = []
+	for name, graph in [('mono', 'sine=frequency=440:duration=2'),
+						('stereo', 'sine=frequency=440:duration=2[a];sine=frequency=660:duration=2[b];[a][b]amerge=inputs=2')]:
+		path = os.path.join(tmpdir, name + '.mp3')
+		subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', graph,
+						'-ar', '44100', path], check=True)
+		paths.append(path)
+	return paths
+
+def reference(path, sr, tmpdir):
+	wavpath = os.path.join(tmpdir, 'temp.wav')
+	subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', path, wavpath], check=True)
+	return librosa.load(wavpath, sr=sr)[0]
+
+def check(path, sr, tmpdir, tolerance, level_tolerance):
+	old, new = reference(path, sr, tmpdir), audio.load_wav(path, sr)
+	n = min(len(old), len(new))
+	diff = np.abs(old[:n] - new[:n]).max()
+	level = np.sqrt(np.mean(new[:n] ** 2) / max(np.mean(old[:n] ** 2), 1e-20))
+
+	ok = diff <= tolerance and abs(level - 1) <= level_tolerance and abs(len(old) - len(new)) <= 1
+	print('{}: {} / {} samples, max |diff| {:.2e}, level {:.4f} {}'.format(
+		os.path.basename(path), len(new), len(old), diff, level, 'ok' if ok else 'MISMATCH'))
+	return ok
+
+def main(args):
+	with tempfile.TemporaryDirectory() as tmpdir:
+		paths = args.audio or generate(tmpdir)
+		ok = True
+		for path in paths:
+			ok &= check(path, hp.sample_rate, tmpdir, args.tolerance, args.level_tolerance)
+	sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+	main(parser.parse_args())
@@ -0,0 +1,69 @@
+"""Checks that the batched S3FD NMS (bbox.batch_nms) keeps exactly the boxes the
+per-image NumPy nms keeps.
+
+Random padded batches are generated the way the detector produces them: up to
+top_k boxes per image in descending score order, clustered around a few faces,
+with a varying number of valid rows (including none and one) and scattered
+invalid rows. Each image is run through nms on its valid rows and compared with
+the rows batch_nms keeps. Exits with status 1 on any mismatch.
+
+	python check_nms.py
+	python check_nms.py --batches 50 --thresholds 0.3
+"""
+import argparse, sys, time
+import numpy as np
+import torch
+
+from face_detection.detection.sfd.bbox import nms, batch_nms
+
+parser = argparse.ArgumentParser(description='Compare batch_nms with the per-image nms')
+parser.add_argument('--batches', type=int, default=20, help='Random batches per threshold')
+parser.add_argument('--batch_size', type=int, default=16, help='Images per batch')
+parser.add_argument('--top_k', type=int, default=750, help='Boxes per image, valid or not')
+parser.add_argument('--thresholds', type=float, nargs='+', default=[0.3, 0.0, 0.5, 0.9], help='IoU thresholds')
+parser.add_argument('--seed', type=int, default=0)
+
+def random_batch(rng, batch_size, top_k):
+	"""A (B, K, 5) float32 batch sorted by descending score and its (B, K) valid mask."""
+	centers = rng.uniform(50, 600, (batch_size, 8, 2))
+	c = centers[np.arange(batch_size)[:, None], rng.integers(0, 8, (batch_size, top_k))]
+	c = c + rng.normal(0, 15, (batch_size, top_k, 2))
+	wh = rng.uniform(20, 120, (batch_size, top_k, 2))
+	scores = rng.permutation(batch_size * top_k).reshape(batch_size, top_k) / float(batch_size * top_k)
+	dets = np.concatenate([c - wh / 2, c + wh / 2, scores[..., None]], 2).astype(np.float32)
+	dets = np.take_along_axis(dets, np.argsort(-dets[..., 4], 1)[..., None], 1)
+
+	nvalid = rng.integers(0, top_k + 1, batch_size)
+	nvalid[:2] = [0, 1]
+	valid = (np.arange(top_k)[None] < nvalid[:, None]) & (rng.random((batch_size, top_k)) > 0.1)
+	return dets, valid
+
+def check(dets, valid, thresh):
+	"""Number of images whose kept rows differ, and the time of each implementation."""
+	start = time.time()
+	expected = [set(np.flatnonzero(v)[nms(d[v], thresh)].tolist()) for d, v in zip(dets, valid)]
+	nms_time = time.time() - start
+
+	start = time.time()
+	keep = batch_nms(torch.from_numpy(dets), torch.from_numpy(valid), thresh).numpy()
+	batch_time = time.time() - start
+
+	mismatches = sum(set(np.flatnonzero(k).tolist()) != e for k, e in zip(keep, expected))
+	return mismatches, nms_time, batch_time
+
+def main(args):
+	rng = np.random.default_rng(args.seed)
+	ok = True
+	for thresh in args.thresholds:
+		mismatches, nms_time, batch_time = 0, 0., 0.
+		for _ in range(args.batches):
+			m, t1, t2 = check(*random_batch(rng, args.batch_size, args.top_k), thresh=thresh)
+			mismatches, nms_time, batch_time = mismatches + m, nms_time + t1, batch_time + t2
+		images = args.batches * args.batch_size
+		print('threshold {:.2f}: {} of {} images differ (nms {:.2f}s, batch_nms {:.2f}s) {}'.format(
+			thresh, mismatches, images, nms_time, batch_time, 'ok' if not mismatches else 'MISMATCH'))
+		ok &= not mismatches
+	sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+	main(parser.parse_args())
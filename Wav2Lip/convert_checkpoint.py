@@ -0,0 +1,56 @@
+"""Converts a Wav2Lip, SyncNet_color or S3FD checkpoint to a weights-only file
+in the safetensors layout, which inference.py and the face detector memory-map.
+
+Training checkpoints carry the optimizer state (with save_optimizer_state) and
+are unpickled as a whole, after which load_model copies every tensor to strip
+the ``module.`` prefix. The converted file holds only the model weights with
+normalized names, so a cold start reads just those bytes. --half stores them as
+float16, halving the file; they are cast back to float32 on load.
+
+	python convert_checkpoint.py --checkpoint_path checkpoints/wav2lip_gan.pth
+	python inference.py --checkpoint_path checkpoints/wav2lip_gan.safetensors ...
+
+Saved as face_detection/detection/sfd/s3fd.safetensors, the S3FD weights are
+picked up automatically.
+"""
+import argparse, os, time
+import torch
+
+from face_detection.utils import save_weights, load_weights
+
+parser = argparse.ArgumentParser(description='Convert a checkpoint to a memory-mappable weights-only file')
+parser.add_argument('--checkpoint_path', type=str, required=True,
+					help='Wav2Lip or SyncNet checkpoint written by the training scripts, or s3fd.pth')
+parser.add_argument('--outfile', type=str, default=None,
+					help='Where to save the weights (default: the checkpoint path with .safetensors)')
+parser.add_argument('--half', action='store_true', help='Store floating point weights as float16')
+
+def main(args):
+	outfile = args.outfile or os.path.splitext(args.checkpoint_path)[0] + '.safetensors'
+
+	start = time.time()
+	checkpoint = torch.load(args.checkpoint_path, map_location='cpu')
+	pickle_time = time.time() - start
+	# Training checkpoints wrap the weights with the optimizer state and the step;
+	# s3fd.pth is a bare state dict.
+	state_dict = checkpoint.get('state_dict', checkpoint)
+	metadata = {k: str(checkpoint[k]) for k in ('global_step', 'global_epoch') if k in checkpoint}
+	if checkpoint.get('optimizer') is not None:
+		print('Dropping the optimizer state')
+
+	save_weights(state_dict, outfile, half=args.half, metadata=metadata)
+
+	start = time.time()
+	weights, _ = load_weights(outfile)
+	load_time = time.time() - start
+	diff = max((weights[k.replace('module.', '')].float() - v.float()).abs().max().item()
+				for k, v in state_dict.items() if v.numel())
+
+	print('{}: {:.1f} MB -> {}: {:.1f} MB, {} tensors, max |diff| {:.2e}'.format(
+		args.checkpoint_path, os.path.getsize(args.checkpoint_path) / 2**20,
+		outfile, os.path.getsize(outfile) / 2**20, len(weights), diff))
+	print('Open time: torch.load {:.1f} ms, memory-mapped {:.1f} ms (tensor data is read on first use)'.format(
+		pickle_time * 1000, load_time * 1000))
+
+if __name__ == '__main__':
+	main(parser.parse_args())
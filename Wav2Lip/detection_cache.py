@@ -0,0 +1,70 @@
+import os, hashlib, json, tempfile
+import numpy as np
+
+def default_cache_dir():
+	return os.path.join(os.path.expanduser('~'), '.cache', 'wav2lip', 'face_det')
+
+class DetectionCache:
+	"""Content-addressed on-disk cache of per-frame face boxes.
+
+	Entries are keyed by a hash of the source file's bytes plus the parameters
+	that change the frames seen by the detector, and stored as compressed npz
+	files holding an (N, 4) int32 array of raw (x1, y1, x2, y2) detections.
+	The directory is kept under ``max_bytes`` by evicting the least recently
+	used entries (hits refresh the file's mtime).
+	"""
+
+	def __init__(self, root=None, max_bytes=512 << 20):
+		self.root = root or default_cache_dir()
+		self.max_bytes = max_bytes
+		os.makedirs(self.root, exist_ok=True)
+
+	@staticmethod
+	def key(path, **params):
+		h = hashlib.blake2b(digest_size=20)
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), b''):
+				h.update(chunk)
+		h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+		return h.hexdigest()
+
+	def _path(self, key):
+		return os.path.join(self.root, key + '.npz')
+
+	def get(self, key):
+		path = self._path(key)
+		try:
+			with np.load(path) as entry:
+				boxes = entry['boxes']
+		except (OSError, KeyError, ValueError):
+			return None
+		os.utime(path)
+		return boxes
+
+	def put(self, key, boxes):
+		fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.root)
+		with os.fdopen(fd, 'wb') as f:
+			np.savez_compressed(f, boxes=np.asarray(boxes, dtype=np.int32))
+		os.replace(tmp, self._path(key))
+		self.evict()
+
+	def evict(self):
+		entries = []
+		for name in os.listdir(self.root):
+			if not name.endswith('.npz'):
+				continue
+			try:
+				st = os.stat(os.path.join(self.root, name))
+			except FileNotFoundError:
+				continue
+			entries.append((st.st_mtime, st.st_size, name))
+
+		total = sum(size for _, size, _ in entries)
+		for _, size, name in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(os.path.join(self.root, name))
+			except FileNotFoundError:
+				pass
+			total -= size
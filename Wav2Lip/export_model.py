@@ -0,0 +1,74 @@
+"""Exports an inference-optimized Wav2Lip as a frozen TorchScript file.
+
+BatchNorm layers are folded into their convolutions (models/fuse.py) and the
+model is traced and frozen. The result can be passed to inference.py as
+--checkpoint_path; load_model then runs torch.jit.optimize_for_inference on it,
+which fuses the remaining conv/add/ReLU chains where the backend supports it
+(its output cannot be serialized, so it is applied at load time). The saved
+model is reloaded that same way, checked for parity against the eager model and
+benchmarked per batch size.
+"""
+import argparse, os, time
+import torch
+
+import inference
+from models import fuse_model
+
+parser = argparse.ArgumentParser(description='Export a BatchNorm-folded, frozen TorchScript Wav2Lip')
+parser.add_argument('--checkpoint_path', type=str, required=True, help='Wav2Lip checkpoint to export')
+parser.add_argument('--outfile', type=str, required=True, help='Where to save the TorchScript model')
+parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 16, 64, 128],
+					help='Batch sizes to check parity and benchmark at')
+parser.add_argument('--repeats', type=int, default=5, help='Timed runs per batch size')
+parser.add_argument('--atol', type=float, default=1e-4, help='Maximum allowed absolute output difference')
+
+def example_inputs(batch_size, device):
+	mel = torch.randn(batch_size, 1, 80, 16, device=device)
+	face = torch.rand(batch_size, 6, 96, 96, device=device)
+	return mel, face
+
+@torch.no_grad()
+def export(model, device):
+	fused = fuse_model(model).to(device)
+	traced = torch.jit.trace(fused, example_inputs(2, device), check_trace=False)
+	return torch.jit.freeze(traced.eval())
+
+@torch.no_grad()
+def benchmark(model, inputs, repeats):
+	model(*inputs) # warm-up, also lets the JIT specialize
+	start = time.perf_counter()
+	for _ in range(repeats):
+		model(*inputs)
+	return (time.perf_counter() - start) / repeats
+
+@torch.no_grad()
+def compare(eager, exported, batch_sizes, repeats, device):
+	"""Returns [(batch_size, max_abs_diff, eager_seconds, exported_seconds), ...]."""
+	results = []
+	for bs in batch_sizes:
+		inputs = example_inputs(bs, device)
+		diff = (eager(*inputs) - exported(*inputs)).abs().max().item()
+		results.append((bs, diff, benchmark(eager, inputs, repeats), benchmark(exported, inputs, repeats)))
+	return results
+
+def main(args):
+	device = inference.get_device()
+	eager = inference.load_model(args.checkpoint_path)
+	torch.jit.save(export(eager, device), args.outfile)
+	exported = inference.load_model(args.outfile)
+
+	print('{:>6} {:>12} {:>10} {:>10} {:>8}'.format('batch', 'max |diff|', 'eager', 'exported', 'speedup'))
+	worst = 0.
+	for bs, diff, t_eager, t_exported in compare(eager, exported, args.batch_sizes, args.repeats, device):
+		worst = max(worst, diff)
+		print('{:>6} {:>12.2e} {:>9.1f}ms {:>9.1f}ms {:>7.2f}x'.format(
+			bs, diff, t_eager * 1000, t_exported * 1000, t_eager / t_exported))
+
+	if worst > args.atol:
+		os.remove(args.outfile)
+		raise ValueError('Exported model differs from the eager model by {:.2e} (> --atol {:.2e})'.format(worst, args.atol))
+
+	print('Saved TorchScript model to {}'.format(args.outfile))
+
+if __name__ == '__main__':
+	main(parser.parse_args())
@@ -0,0 +1,103 @@
+"""Exports Wav2Lip and the S3FD face detector to ONNX for the onnxruntime backend.
+
+Wav2Lip is exported with its BatchNorm layers folded (models/fuse.py) and a
+dynamic batch axis; S3FD with dynamic batch, height and width axes. By default
+the files are written where ``inference.py --backend onnxruntime`` looks for them:
+
+	<checkpoint>.onnx                                    Wav2Lip
+	face_detection/detection/sfd/s3fd.onnx               S3FD
+
+Both exports are reloaded with ONNX Runtime's CPU execution provider, checked
+for parity against the torch models and benchmarked per batch size.
+"""
+import argparse, os
+import torch
+
+import inference
+from export_model import benchmark
+from face_detection.utils import OnnxModule
+from models import fuse_model
+
+parser = argparse.ArgumentParser(description='Export Wav2Lip and S3FD to ONNX with dynamic batch axes')
+parser.add_argument('--checkpoint_path', type=str, required=True, help='Wav2Lip checkpoint to export')
+parser.add_argument('--outfile', type=str, default=None,
+					help='Where to save the Wav2Lip ONNX model (default: next to the checkpoint)')
+parser.add_argument('--s3fd_outfile', type=str, default=inference.S3FD_ONNX_PATH,
+					help='Where to save the S3FD ONNX model')
+parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 16, 64],
+					help='Batch sizes to check parity and benchmark at')
+parser.add_argument('--s3fd_size', nargs=2, type=int, default=[360, 640],
+					help='Frame height and width used to check S3FD')
+parser.add_argument('--repeats', type=int, default=5, help='Timed runs per batch size')
+parser.add_argument('--atol', type=float, default=1e-3, help='Maximum allowed absolute output difference')
+parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+
+S3FD_OUTPUTS = ['{}{}'.format(kind, i) for i in range(1, 7) for kind in ('cls', 'reg')]
+
+def wav2lip_inputs(batch_size):
+	return torch.randn(batch_size, 1, 80, 16), torch.rand(batch_size, 6, 96, 96)
+
+def s3fd_inputs(batch_size, height, width):
+	return (torch.rand(batch_size, 3, height, width) * 255 - 128,)
+
+@torch.no_grad()
+def export_wav2lip(model, path, opset):
+	torch.onnx.export(fuse_model(model).cpu(), wav2lip_inputs(2), path, opset_version=opset,
+					dynamo=False, input_names=['audio_sequences', 'face_sequences'], output_names=['output'],
+					dynamic_axes={'audio_sequences': {0: 'batch'}, 'face_sequences': {0: 'batch'},
+								'output': {0: 'batch'}})
+
+@torch.no_grad()
+def export_s3fd(model, path, opset):
+	axes = {0: 'batch', 2: 'height', 3: 'width'}
+	torch.onnx.export(model.cpu().eval(), s3fd_inputs(1, 256, 256), path, opset_version=opset,
+					dynamo=False, input_names=['images'], output_names=S3FD_OUTPUTS,
+					dynamic_axes=dict({'images': axes}, **{name: axes for name in S3FD_OUTPUTS}))
+
+@torch.no_grad()
+def compare(model, exported, inputs_for, batch_sizes, repeats):
+	"""Returns [(batch_size, max_abs_diff, torch_seconds, onnx_seconds), ...]."""
+	results = []
+	for bs in batch_sizes:
+		inputs = inputs_for(bs)
+		expected, actual = model(*inputs), exported(*inputs)
+		if torch.is_tensor(expected):
+			expected, actual = [expected], [actual]
+		diff = max((a - b).abs().max().item() for a, b in zip(expected, actual))
+		results.append((bs, diff, benchmark(model, inputs, repeats), benchmark(exported, inputs, repeats)))
+	return results
+
+def report(name, results):
+	print(name)
+	print('{:>6} {:>12} {:>10} {:>10} {:>8}'.format('batch', 'max |diff|', 'torch', 'onnx', 'speedup'))
+	for bs, diff, t_torch, t_onnx in results:
+		print('{:>6} {:>12.2e} {:>9.1f}ms {:>9.1f}ms {:>7.2f}x'.format(
+			bs, diff, t_torch * 1000, t_onnx * 1000, t_torch / t_onnx))
+	return max(diff for _, diff, _, _ in results)
+
+def main(args):
+	if inference.get_device() != 'cpu':
+		raise ValueError('The onnxruntime backend runs on CPU; run this on a CPU-only machine')
+	outfile = args.outfile or inference.onnx_checkpoint_path(args.checkpoint_path)
+	threads = torch.get_num_threads()
+
+	wav2lip = inference.load_model(args.checkpoint_path)
+	export_wav2lip(wav2lip, outfile, args.opset)
+	worst = report('Wav2Lip', compare(wav2lip, OnnxModule(outfile, threads), wav2lip_inputs,
+									args.batch_sizes, args.repeats))
+
+	s3fd = inference.get_detector().face_detector.face_detector
+	export_s3fd(s3fd, args.s3fd_outfile, args.opset)
+	height, width = args.s3fd_size
+	worst = max(worst, report('S3FD', compare(s3fd, OnnxModule(args.s3fd_outfile, threads),
+									lambda bs: s3fd_inputs(bs, height, width), args.batch_sizes[:2], args.repeats)))
+
+	if worst > args.atol:
+		os.remove(outfile)
+		os.remove(args.s3fd_outfile)
+		raise ValueError('ONNX models differ from the torch models by {:.2e} (> --atol {:.2e})'.format(worst, args.atol))
+
+	print('Saved ONNX models to {} and {}'.format(outfile, args.s3fd_outfile))
+
+if __name__ == '__main__':
+	main(parser.parse_args())
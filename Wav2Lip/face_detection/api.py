@@ -43,15 +43,24 @@ class NetworkSize(Enum):
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 
+models_urls = {
+    '2DFAN-4': 'https://www.adrianbulat.com/downloads/python-fan/2DFAN4-11f355bf06.pth.tar',
+}
+
 class FaceAlignment:
     def __init__(self, landmarks_type, network_size=NetworkSize.LARGE,
-                 device='cuda', flip_input=False, face_detector='sfd', verbose=False):
+                 device='cuda', flip_input=False, face_detector='sfd', verbose=False,
+                 face_detector_kwargs=None, path_to_fan=None):
         self.device = device
         self.flip_input = flip_input
         self.landmarks_type = landmarks_type
         self.verbose = verbose
+        self.path_to_fan = path_to_fan
 
         network_size = int(network_size)
+        self.network_size = network_size
+        # FAN is only loaded by the first call to get_landmarks_for_batch
+        self.face_alignment_net = None
 
         if 'cuda' in device:
             torch.backends.cudnn.benchmark = True
@@ -59,9 +68,21 @@ class FaceAlignment:
         # Get the face detector
         face_detector_module = __import__('face_detection.detection.' + face_detector,
                                           globals(), locals(), [face_detector], 0)
-        self.face_detector = face_detector_module.FaceDetector(device=device, verbose=verbose)
+        self.face_detector = face_detector_module.FaceDetector(device=device, verbose=verbose,
+                                                               **(face_detector_kwargs or {}))
+
+    def get_detections_for_batch(self, images, max_side=None):
+        """Returns the first face box (x1, y1, x2, y2) found in each of the (N, H, W, 3)
+        BGR ``images``, or None. With ``max_side``, larger images are downscaled so
+        their longer side is ``max_side`` for detection, and the boxes are mapped
+        back to full resolution.
+        """
+        scale = 1.
+        if max_side and max(images.shape[1:3]) > max_side:
+            scale = max_side / float(max(images.shape[1:3]))
+            size = (int(round(images.shape[2] * scale)), int(round(images.shape[1] * scale)))
+            images = np.stack([cv2.resize(image, size, interpolation=cv2.INTER_AREA) for image in images])
 
-    def get_detections_for_batch(self, images):
         images = images[..., ::-1]
         detected_faces = self.face_detector.detect_from_batch(images.copy())
         results = []
@@ -73,7 +94,63 @@ class FaceAlignment:
             d = d[0]
             d = np.clip(d, 0, None)
             
-            x1, y1, x2, y2 = map(int, d[:-1])
+            x1, y1, x2, y2 = map(int, d[:-1] / scale)
             results.append((x1, y1, x2, y2))
 
-        return results
\ No newline at end of file
+        return results
+
+    def _landmark_net(self):
+        if self.landmarks_type != LandmarksType._2D:
+            raise ValueError('Only 2D landmarks are supported, got {}'.format(self.landmarks_type))
+        if self.face_alignment_net is None:
+            if self.path_to_fan is not None:
+                fan_weights = torch.load(self.path_to_fan, map_location='cpu')
+            else:
+                fan_weights = load_url(models_urls['2DFAN-' + str(self.network_size)], map_location='cpu')
+            self.face_alignment_net = FAN(self.network_size)
+            self.face_alignment_net.load_state_dict(fan_weights)
+            self.face_alignment_net.to(self.device).eval()
+        return self.face_alignment_net
+
+    @torch.no_grad()
+    def get_landmarks_for_batch(self, images, boxes=None, batch_size=32):
+        """Returns the 68 (x, y) landmarks of one face in each of the (N, H, W, 3)
+        BGR ``images`` as a (68, 2) array, or None. ``boxes`` holds one (x1, y1,
+        x2, y2) face box or None per image, as returned by get_detections_for_batch,
+        which is called when they are not given. The mouth is points 48 to 67.
+
+        All faces go through FAN ``batch_size`` at a time and their heatmaps are
+        decoded together.
+        """
+        if boxes is None:
+            boxes = self.get_detections_for_batch(images)
+        results = [None] * len(images)
+        found = [i for i, box in enumerate(boxes) if box is not None]
+        if not found:
+            return results
+
+        centers, scales, crops = [], [], []
+        for i in found:
+            x1, y1, x2, y2 = boxes[i]
+            center = np.array([x2 - (x2 - x1) / 2.0, y2 - (y2 - y1) / 2.0])
+            center[1] = center[1] - (y2 - y1) * 0.12
+            scale = (x2 - x1 + y2 - y1) / self.face_detector.reference_scale
+            centers.append(center)
+            scales.append(scale)
+            crops.append(crop(images[i][..., ::-1], center, scale))  # FAN takes RGB
+
+        net = self._landmark_net()
+        heatmaps = []
+        for start in range(0, len(crops), batch_size):
+            inp = np.stack(crops[start:start + batch_size]).transpose(0, 3, 1, 2)
+            inp = torch.from_numpy(inp).float().div_(255.0).to(self.device)
+            out = net(inp)[-1]
+            if self.flip_input:
+                out += flip(net(flip(inp))[-1], is_label=True)
+            heatmaps.append(out)
+
+        _, pts_img = get_preds_fromhm_batch(torch.cat(heatmaps), np.array(centers), np.array(scales))
+        for i, pts in zip(found, pts_img.cpu().numpy()):
+            results[i] = pts
+
+        return results
@@ -10,22 +10,6 @@ import argparse
 import numpy as np
 import torch
 
-try:
-    from iou import IOU
-except BaseException:
-    # IOU cython speedup 10x
-    def IOU(ax1, ay1, ax2, ay2, bx1, by1, bx2, by2):
-        sa = abs((ax2 - ax1) * (ay2 - ay1))
-        sb = abs((bx2 - bx1) * (by2 - by1))
-        x1, y1 = max(ax1, bx1), max(ay1, by1)
-        x2, y2 = min(ax2, bx2), min(ay2, by2)
-        w = x2 - x1
-        h = y2 - y1
-        if w < 0 or h < 0:
-            return 0.0
-        else:
-            return 1.0 * w * h / (sa + sb - w * h)
-
 
 def bboxlog(x1, y1, x2, y2, axc, ayc, aww, ahh):
     xc, yc, ww, hh = (x2 + x1) / 2, (y2 + y1) / 2, x2 - x1, y2 - y1
@@ -64,6 +48,42 @@ def nms(dets, thresh):
     return keep
 
 
+def batch_nms(dets, valid, thresh):
+    """Greedy NMS over a padded batch, keeping the same boxes as ``nms`` does
+    on each image.
+
+    dets is a (B, K, 5) tensor of (x1, y1, x2, y2, score) with every image's
+    rows in descending score order, and valid a (B, K) mask of the rows to
+    consider. Returns the (B, K) mask of kept rows, computed on dets' device.
+    Each step keeps the best remaining box of every image at once and drops
+    the boxes it overlaps, so the loop runs as many times as the most boxes
+    kept in one image, not once per box or per image.
+    """
+    keep = torch.zeros_like(valid)
+    cols = valid.any(0).nonzero()
+    if 0 == len(cols):
+        return keep
+    n = int(cols[-1]) + 1
+    x1, y1, x2, y2 = dets[:, :n, :4].unbind(2)
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    remaining = valid[:, :n].clone()
+    rows = torch.arange(len(dets), device=dets.device)
+
+    while remaining.any():
+        i = remaining.byte().argmax(1)    # first remaining row, i.e. the best score
+        active = remaining[rows, i]
+        keep[rows, i] |= active
+        remaining[rows, i] = False
+
+        xx1, yy1 = torch.maximum(x1[rows, i, None], x1), torch.maximum(y1[rows, i, None], y1)
+        xx2, yy2 = torch.minimum(x2[rows, i, None], x2), torch.minimum(y2[rows, i, None], y2)
+        w, h = (xx2 - xx1 + 1).clamp(min=0), (yy2 - yy1 + 1).clamp(min=0)
+        ovr = w * h / (areas[rows, i, None] + areas - w * h)
+        remaining &= (ovr <= thresh) | ~active[:, None]
+
+    return keep
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
@@ -6,6 +6,7 @@ import sys
 import cv2
 import random
 import datetime
+import functools
 import math
 import argparse
 import numpy as np
@@ -16,46 +17,48 @@ from .net_s3fd import s3fd
 from .bbox import *
 
 
-def detect(net, img, device):
-    img = img - np.array([104, 117, 123])
-    img = img.transpose(2, 0, 1)
-    img = img.reshape((1,) + img.shape)
-
-    if 'cuda' in device:
-        torch.backends.cudnn.benchmark = True
-
-    img = torch.from_numpy(img).float().to(device)
-    BB, CC, HH, WW = img.size()
-    with torch.no_grad():
-        olist = net(img)
-
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
+# One entry per output level (six per input size). Tracker crops and
+# --face_det_max_side give many input sizes over a long-lived process, so only
+# the most recent ones are kept.
+@functools.lru_cache(maxsize=96)
+def priors_for(height, width, stride, device):
+    """Center-form priors (cx, cy, w, h) of one S3FD output level with a
+    (height, width) feature map, as a (height * width, 4) tensor in row-major
+    order. Cached per size and device."""
+    ys, xs = torch.meshgrid(torch.arange(height, dtype=torch.float32),
+                            torch.arange(width, dtype=torch.float32), indexing='ij')
+    cx = stride / 2 + xs.reshape(-1) * stride
+    cy = stride / 2 + ys.reshape(-1) * stride
+    anchor = torch.full_like(cx, stride * 4)
+    return torch.stack([cx, cy, anchor, anchor], 1).to(device)
+
+
+def decode_detections(olist, threshold=0.05, top_k=750):
+    """Decodes the S3FD outputs [cls1, reg1, ..., cls6, reg6] of a batch on their device.
+
+    Returns (dets, valid): dets is a (B, K, 5) tensor of (x1, y1, x2, y2, score)
+    holding the top_k highest scoring anchors of each image in descending score
+    order, and valid a (B, K) mask of those scoring above ``threshold``.
+    """
+    variances = [0.1, 0.2]
+    scores, boxes = [], []
     for i in range(len(olist) // 2):
         ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
+        B, _, FH, FW = ocls.size()
         stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[0, 1, hindex, windex]
-            loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
-            variances = [0.1, 0.2]
-            box = decode(loc, priors, variances)
-            x1, y1, x2, y2 = box[0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append([x1, y1, x2, y2, score])
-    bboxlist = np.array(bboxlist)
-    if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, 5))
+        priors = priors_for(FH, FW, stride, oreg.device)
+        scores.append(F.softmax(ocls, dim=1)[:, 1].reshape(B, -1))
+        loc = oreg.permute(0, 2, 3, 1).reshape(B, -1, 4)
+        boxes.append(batch_decode(loc, priors[None], variances))
+
+    # NaN scores never pass the threshold; keep them out of the top k.
+    scores, boxes = torch.cat(scores, 1).nan_to_num(0.), torch.cat(boxes, 1)
+    scores, idx = scores.topk(min(top_k, scores.size(1)), dim=1)
+    boxes = boxes.gather(1, idx.unsqueeze(2).expand(-1, -1, 4))
+    return torch.cat([boxes, scores.unsqueeze(2)], 2), scores > threshold
 
-    return bboxlist
 
-def batch_detect(net, imgs, device):
+def _run(net, imgs, device):
     imgs = imgs - np.array([104, 117, 123])
     imgs = imgs.transpose(0, 3, 1, 2)
 
@@ -63,36 +66,27 @@ def batch_detect(net, imgs, device):
         torch.backends.cudnn.benchmark = True
 
     imgs = torch.from_numpy(imgs).float().to(device)
-    BB, CC, HH, WW = imgs.size()
     with torch.no_grad():
-        olist = net(imgs)
+        return decode_detections(net(imgs))
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-            variances = [0.1, 0.2]
-            box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
+
+def detect(net, img, device):
+    dets, valid = _run(net, img[None], device)
+    bboxlist = dets[0][valid[0]].cpu().numpy()
     if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, BB, 5))
+        bboxlist = np.zeros((1, 5))
 
     return bboxlist
 
+def batch_detect(net, imgs, device, nms_thresh=None):
+    """Returns one (N_i, 5) array of (x1, y1, x2, y2, score) per image, holding its
+    anchors that score above 0.05 in descending score order. With ``nms_thresh``,
+    only the boxes that survive non-maximum suppression are returned."""
+    dets, valid = _run(net, imgs, device)
+    if nms_thresh is not None:
+        valid = batch_nms(dets, valid, nms_thresh)
+    return [d[v].cpu().numpy() for d, v in zip(dets, valid)]
+
 def flip_detect(net, img, device):
     img = cv2.flip(img, 1)
     b = detect(net, img, device)
@@ -3,6 +3,7 @@ import cv2
 from torch.utils.model_zoo import load_url
 
 from ..core import FaceDetector
+from ...utils import is_torchscript, is_weights_file, load_weights, OnnxModule, to_bf16
 
 from .net_s3fd import s3fd
 from .bbox import *
@@ -14,11 +15,25 @@ models_urls = {
 
 
 class SFDDetector(FaceDetector):
-    def __init__(self, device, path_to_detector=os.path.join(os.path.dirname(os.path.abspath(__file__)), 's3fd.pth'), verbose=False):
+    def __init__(self, device, path_to_detector=os.path.join(os.path.dirname(os.path.abspath(__file__)), 's3fd.pth'), verbose=False,
+                 bf16=False):
         super(SFDDetector, self).__init__(device, verbose)
 
         # Initialise the face detector
-        if not os.path.isfile(path_to_detector):
+        if path_to_detector.endswith('.onnx'):
+            # written by export_onnx.py, run with ONNX Runtime on CPU
+            self.face_detector = OnnxModule(path_to_detector, torch.get_num_threads())
+            return
+
+        if os.path.isfile(path_to_detector) and is_torchscript(path_to_detector):
+            # e.g. the INT8 model written by quantize_models.py
+            self.face_detector = torch.jit.load(path_to_detector, map_location=device).eval()
+            return
+
+        if is_weights_file(path_to_detector):
+            # written by convert_checkpoint.py, memory-mapped
+            model_weights, _ = load_weights(path_to_detector)
+        elif not os.path.isfile(path_to_detector):
             model_weights = load_url(models_urls['s3fd'])
         else:
             model_weights = torch.load(path_to_detector)
@@ -28,6 +43,10 @@ class SFDDetector(FaceDetector):
         self.face_detector.to(device)
         self.face_detector.eval()
 
+        if bf16:
+            example = torch.rand(1, 3, 256, 256, device=device) * 255 - 128
+            self.face_detector = to_bf16(self.face_detector, (example,), name='S3FD')
+
     def detect_from_image(self, tensor_or_path):
         image = self.tensor_or_path_to_ndarray(tensor_or_path)
 
@@ -39,9 +58,7 @@ class SFDDetector(FaceDetector):
         return bboxlist
 
     def detect_from_batch(self, images):
-        bboxlists = batch_detect(self.face_detector, images, device=self.device)
-        keeps = [nms(bboxlists[:, i, :], 0.3) for i in range(bboxlists.shape[1])]
-        bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
+        bboxlists = batch_detect(self.face_detector, images, device=self.device, nms_thresh=0.3)
         bboxlists = [[x for x in bboxlist if x[-1] > 0.5] for bboxlist in bboxlists]
 
         return bboxlists
@@ -4,10 +4,161 @@ import sys
 import time
 import torch
 import math
+import json
+import struct
+import zipfile
 import numpy as np
 import cv2
 
 
+def is_torchscript(path):
+    """Tells TorchScript archives (torch.jit.save) apart from torch.save checkpoints."""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return any('/code/' in name for name in archive.namelist())
+    except zipfile.BadZipFile:
+        return False
+
+
+_SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
+
+def is_weights_file(path):
+    return path.endswith('.safetensors')
+
+
+def save_weights(state_dict, path, half=False, metadata=None):
+    """Writes ``state_dict`` in the safetensors layout: an 8-byte header size, a
+    JSON header with each tensor's dtype, shape and byte range, then the raw
+    tensor data. The ``module.`` prefix left by DataParallel is removed from the
+    names, and with ``half`` floating point tensors are stored as float16.
+    ``metadata`` is a dict of strings kept in the header.
+    """
+    names = {dtype: name for name, dtype in _SAFETENSORS_DTYPES.items()}
+    tensors, header, offset = [], {}, 0
+    for k, v in state_dict.items():
+        v = v.detach().cpu().contiguous()
+        if half and v.is_floating_point():
+            v = v.half()
+        data = v.reshape(-1).view(torch.uint8).numpy()
+        header[k.replace('module.', '')] = {'dtype': names[v.dtype], 'shape': list(v.shape),
+                                            'data_offsets': [offset, offset + len(data)]}
+        tensors.append(data)
+        offset += len(data)
+    header['__metadata__'] = dict(metadata or {}, format='pt')
+
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)  # keeps the tensor data 8-byte aligned
+    with open(path + '.tmp', 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for data in tensors:
+            f.write(data.tobytes())
+    os.replace(path + '.tmp', path)
+
+
+def load_weights(path):
+    """Returns the (state_dict, metadata) of a file written by save_weights (or by
+    the safetensors library). The tensors are copy-on-write memory maps of the
+    file, so only the bytes that are used get read.
+    """
+    with open(path, 'rb') as f:
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size))
+    metadata = header.pop('__metadata__', {})
+    if not header:
+        return {}, metadata
+
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + size)
+    state_dict = {}
+    for name, info in header.items():
+        begin, end = info['data_offsets']
+        tensor = torch.from_numpy(data[begin:end]).view(_SAFETENSORS_DTYPES[info['dtype']])
+        state_dict[name] = tensor.reshape(info['shape'])
+    return state_dict, metadata
+
+
+class OnnxModule(object):
+    """Runs an ONNX model with ONNX Runtime's CPU execution provider behind the
+    call signature of the torch module it was exported from: tensors in, a
+    tensor (or a list of tensors for several outputs) out. The pre- and
+    post-processing around it stays in torch.
+    """
+
+    def __init__(self, path, num_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.nbytes = os.path.getsize(path)
+
+    def __call__(self, *inputs):
+        feeds = {name: x.detach().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(o) for o in self.session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def eval(self):
+        return self
+
+
+def bf16_supported():
+    """True if this CPU has native bfloat16 instructions (AVX512-BF16 or AMX)."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class ChannelsLastBf16(torch.nn.Module):
+    """Runs a CPU module in channels_last memory format under bfloat16 autocast.
+    Outputs are cast back to float32, as the wrapped module returns them.
+    """
+
+    def __init__(self, module):
+        super(ChannelsLastBf16, self).__init__()
+        self.module = module.to(memory_format=torch.channels_last)
+
+    def forward(self, *inputs):
+        inputs = [x.contiguous(memory_format=torch.channels_last) for x in inputs]
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            outputs = self.module(*inputs)
+        if torch.is_tensor(outputs):
+            return outputs.float()
+        return [o.float() for o in outputs]
+
+
+@torch.no_grad()
+def to_bf16(module, example_inputs, rtol=0.05, name='model'):
+    """Returns ``module`` wrapped in ChannelsLastBf16 if this machine supports
+    bfloat16 and the wrapped outputs on ``example_inputs`` stay within ``rtol``
+    (max abs difference relative to the largest fp32 output) of fp32. Otherwise
+    ``module`` is returned unchanged.
+    """
+    if next(module.parameters()).device.type != 'cpu' or not bf16_supported():
+        print('bfloat16 is not supported on this device, running {} in fp32'.format(name))
+        return module
+
+    expected = module(*example_inputs)
+    wrapped = ChannelsLastBf16(module)
+    actual = wrapped(*example_inputs)
+    if torch.is_tensor(expected):
+        expected, actual = [expected], [actual]
+    error = max((e - a).abs().max().item() / max(e.abs().max().item(), 1e-6) for e, a in zip(expected, actual))
+
+    if error > rtol:
+        print('{} in bfloat16 differs from fp32 by {:.2e} (> {:.2e}), running it in fp32'.format(name, error, rtol))
+        return wrapped.module
+    print('Running {} in bfloat16 / channels_last (relative difference to fp32: {:.2e})'.format(name, error))
+    return wrapped
+
+
 def _gaussian(
         size=3, sigma=0.25, amplitude=1, normalize=False, width=None,
         height=None, sigma_horz=None, sigma_vert=None, mean_horz=0.5,
@@ -129,6 +280,60 @@ def crop(image, center, scale, resolution=256.0):
     return newImg
 
 
+def transform_batch(points, centers, scales, resolution, invert=False):
+    """Batched version of ``transform``.
+
+    Arguments:
+        points {torch.tensor} -- [B, N, 2] points, transformed row by row
+        centers {torch.tensor or numpy.array} -- [B, 2] centers, one per row
+        scales {torch.tensor or numpy.array} -- [B] scales, one per row
+        resolution {float} -- the output resolution
+
+    Keyword Arguments:
+        invert {bool} -- apply the inverse transformations (default: {False})
+    """
+    centers = torch.as_tensor(centers, dtype=torch.float64).reshape(-1, 2)
+    scales = torch.as_tensor(scales, dtype=torch.float64).reshape(-1)
+
+    h = 200.0 * scales
+    t = torch.eye(3, dtype=torch.float64).repeat(len(h), 1, 1)
+    t[:, 0, 0] = resolution / h
+    t[:, 1, 1] = resolution / h
+    t[:, 0, 2] = resolution * (-centers[:, 0] / h + 0.5)
+    t[:, 1, 2] = resolution * (-centers[:, 1] / h + 0.5)
+    t = t.float().to(points.device)
+
+    if invert:
+        t = torch.inverse(t)
+
+    points = torch.cat([points.float(), torch.ones_like(points[..., :1], dtype=torch.float32)], 2)
+    new_points = torch.matmul(t[:, None], points[..., None])[..., :2, 0]
+
+    return new_points.int()
+
+
+def _get_preds_fromhm(hm):
+    """Heatmap maxima with quarter-pixel refinement, as [B, N, 2] (x, y) points."""
+    B, N, H, W = hm.shape
+    flat = hm.reshape(B, N, H * W)
+    _, idx = torch.max(flat, 2)
+    px, py = idx % W, idx // W
+    preds = torch.stack([px, py], 2).float() + 1
+
+    # Move a quarter pixel towards the higher neighbour, away from the border.
+    inside = (px > 0) & (px < W - 1) & (py > 0) & (py < H - 1)
+    px, py = px.clamp(1, W - 2), py.clamp(1, H - 2)
+
+    def at(y, x):
+        return flat.gather(2, (y * W + x).unsqueeze(2)).squeeze(2)
+
+    diff = torch.stack([at(py, px + 1) - at(py, px - 1),
+                        at(py + 1, px) - at(py - 1, px)], 2)
+    preds.add_(diff.sign_().mul_(.25) * inside.unsqueeze(2))
+
+    return preds.add_(-.5)
+
+
 def get_preds_fromhm(hm, center=None, scale=None):
     """Obtain (x,y) coordinates given a set of N heatmaps. If the center
     and the scale is provided the function will return the points also in
@@ -141,33 +346,10 @@ def get_preds_fromhm(hm, center=None, scale=None):
         center {torch.tensor} -- the center of the bounding box (default: {None})
         scale {float} -- face scale (default: {None})
     """
-    max, idx = torch.max(
-        hm.view(hm.size(0), hm.size(1), hm.size(2) * hm.size(3)), 2)
-    idx += 1
-    preds = idx.view(idx.size(0), idx.size(1), 1).repeat(1, 1, 2).float()
-    preds[..., 0].apply_(lambda x: (x - 1) % hm.size(3) + 1)
-    preds[..., 1].add_(-1).div_(hm.size(2)).floor_().add_(1)
-
-    for i in range(preds.size(0)):
-        for j in range(preds.size(1)):
-            hm_ = hm[i, j, :]
-            pX, pY = int(preds[i, j, 0]) - 1, int(preds[i, j, 1]) - 1
-            if pX > 0 and pX < 63 and pY > 0 and pY < 63:
-                diff = torch.FloatTensor(
-                    [hm_[pY, pX + 1] - hm_[pY, pX - 1],
-                     hm_[pY + 1, pX] - hm_[pY - 1, pX]])
-                preds[i, j].add_(diff.sign_().mul_(.25))
-
-    preds.add_(-.5)
-
-    preds_orig = torch.zeros(preds.size())
     if center is not None and scale is not None:
-        for i in range(hm.size(0)):
-            for j in range(hm.size(1)):
-                preds_orig[i, j] = transform(
-                    preds[i, j], center, scale, hm.size(2), True)
-
-    return preds, preds_orig
+        center = torch.as_tensor(np.asarray(center, dtype=np.float64)).reshape(1, 2).repeat(hm.size(0), 1)
+        scale = torch.full((hm.size(0),), float(scale), dtype=torch.float64)
+    return get_preds_fromhm_batch(hm, center, scale)
 
 def get_preds_fromhm_batch(hm, centers=None, scales=None):
     """Obtain (x,y) coordinates given a set of N heatmaps. If the centers
@@ -181,31 +363,11 @@ def get_preds_fromhm_batch(hm, centers=None, scales=None):
         centers {torch.tensor} -- the centers of the bounding box (default: {None})
         scales {float} -- face scales (default: {None})
     """
-    max, idx = torch.max(
-        hm.view(hm.size(0), hm.size(1), hm.size(2) * hm.size(3)), 2)
-    idx += 1
-    preds = idx.view(idx.size(0), idx.size(1), 1).repeat(1, 1, 2).float()
-    preds[..., 0].apply_(lambda x: (x - 1) % hm.size(3) + 1)
-    preds[..., 1].add_(-1).div_(hm.size(2)).floor_().add_(1)
-
-    for i in range(preds.size(0)):
-        for j in range(preds.size(1)):
-            hm_ = hm[i, j, :]
-            pX, pY = int(preds[i, j, 0]) - 1, int(preds[i, j, 1]) - 1
-            if pX > 0 and pX < 63 and pY > 0 and pY < 63:
-                diff = torch.FloatTensor(
-                    [hm_[pY, pX + 1] - hm_[pY, pX - 1],
-                     hm_[pY + 1, pX] - hm_[pY - 1, pX]])
-                preds[i, j].add_(diff.sign_().mul_(.25))
-
-    preds.add_(-.5)
-
-    preds_orig = torch.zeros(preds.size())
+    preds = _get_preds_fromhm(hm)
+
+    preds_orig = torch.zeros(preds.size(), device=preds.device)
     if centers is not None and scales is not None:
-        for i in range(hm.size(0)):
-            for j in range(hm.size(1)):
-                preds_orig[i, j] = transform(
-                    preds[i, j], centers[i], scales[i], hm.size(2), True)
+        preds_orig = transform_batch(preds, centers, scales, hm.size(2), True).float()
 
     return preds, preds_orig
 
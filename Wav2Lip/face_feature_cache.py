@@ -0,0 +1,51 @@
+import hashlib
+import torch
+
+class FaceFeatureCache:
+	"""Runs Wav2Lip like its forward, but computes the face encoder's skip
+	features once per unique face input and reuses them for every later batch.
+
+	A static image, or a video shorter than the audio that datagen loops over,
+	feeds the same face input with many different mel chunks; only the audio
+	encoder and the decoder then have to run for those. Faces are keyed by a hash
+	of their input tensor, so any source of repetition is picked up. Features of
+	new faces are kept until ``max_bytes`` is reached; after that only faces that
+	are already cached are reused, which suits the cyclic access of looped videos
+	better than evicting.
+	"""
+
+	def __init__(self, model, max_bytes=1 << 30):
+		self.model = model
+		self.max_bytes = max_bytes
+		self.nbytes = 0
+		self.features = {}
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def key(face):
+		return hashlib.blake2b(face.detach().cpu().numpy().tobytes(), digest_size=16).digest()
+
+	def __call__(self, audio_sequences, face_sequences):
+		keys = [self.key(face) for face in face_sequences]
+		batch = {}
+		new = {}
+		for i, k in enumerate(keys):
+			if k in self.features:
+				batch[k] = self.features[k]
+			elif k not in new:
+				new[k] = i
+
+		self.misses += len(new)
+		self.hits += len(keys) - len(new)
+		if new:
+			feats = self.model.encode_face(face_sequences[list(new.values())])
+			for j, k in enumerate(new):
+				batch[k] = [f[j].clone() for f in feats]
+				size = sum(f.nbytes for f in batch[k])
+				if self.nbytes + size <= self.max_bytes:
+					self.features[k] = batch[k]
+					self.nbytes += size
+
+		feats = [torch.stack([batch[k][layer] for k in keys]) for layer in range(len(batch[keys[0]]))]
+		return self.model.decode(self.model.encode_audio(audio_sequences), feats)
@@ -0,0 +1,119 @@
+import numpy as np
+import cv2
+
+def box_iou(a, b):
+	x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+	x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+	inter = max(0, x2 - x1) * max(0, y2 - y1)
+	union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+	return inter / union if union > 0 else 0.
+
+class KeyframeTracker:
+	"""Face detection that runs the full-frame detector only on keyframes.
+
+	A keyframe's box is padded by ``roi_pad`` times its size into a region of
+	interest that is fixed until the next keyframe. For each following frame,
+	a 32x32 grayscale thumbnail of the region is compared with the keyframe's;
+	if their mean absolute difference is at most ``motion_threshold`` the
+	keyframe box is reused, otherwise the face is re-detected inside the region
+	only (one batch per call). A face that is missing there, touches the edge of
+	the region or overlaps the keyframe box by less than ``min_iou`` counts as a
+	tracking loss, and that frame becomes a new keyframe. Keyframes are also
+	forced every ``interval`` frames.
+
+	``detect`` maps an (N, H, W, 3) array of BGR images to a list of
+	(x1, y1, x2, y2) boxes or None, like FaceAlignment.get_detections_for_batch.
+	The tracker keeps its state between calls, so frames can be fed in chunks.
+	"""
+
+	def __init__(self, detect, interval=25, roi_pad=0.5, motion_threshold=4., min_iou=0.5, min_roi=160):
+		self.detect = detect
+		self.interval = interval
+		self.roi_pad = roi_pad
+		self.motion_threshold = motion_threshold
+		self.min_iou = min_iou
+		self.min_roi = min_roi
+		self.segment = None
+		self.keyframes = 0
+		self.roi_detections = 0
+		self.propagated = 0
+
+	def summary(self):
+		return 'Face detection: {} keyframes, {} region re-detections, {} frames tracked'.format(
+			self.keyframes, self.roi_detections, self.propagated)
+
+	@staticmethod
+	def _thumbnail(image, roi):
+		x1, y1, x2, y2 = roi
+		gray = cv2.cvtColor(image[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+		return cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+	def _roi(self, box, shape):
+		x1, y1, x2, y2 = box
+		cx, cy = (x1 + x2) / 2., (y1 + y2) / 2.
+		half_w = max((x2 - x1) * (1 + 2 * self.roi_pad), self.min_roi) / 2.
+		half_h = max((y2 - y1) * (1 + 2 * self.roi_pad), self.min_roi) / 2.
+		return (max(0, int(cx - half_w)), max(0, int(cy - half_h)),
+				min(shape[1], int(cx + half_w)), min(shape[0], int(cy + half_h)))
+
+	def _keyframe(self, image):
+		self.keyframes += 1
+		box = self.detect(image[None])[0]
+		if box is None:
+			self.segment = None
+		else:
+			roi = self._roi(box, image.shape)
+			self.segment = {'box': box, 'roi': roi, 'thumbnail': self._thumbnail(image, roi),
+							'shape': image.shape[:2], 'left': self.interval - 1}
+		return box
+
+	def _lost(self, rect):
+		if rect is None or box_iou(rect, self.segment['box']) < self.min_iou:
+			return True
+		x1, y1, x2, y2 = self.segment['roi']
+		h, w = self.segment['shape']
+		# A box cut off by the region (but not by the frame) means the face is leaving it.
+		return ((rect[0] <= x1 and x1 > 0) or (rect[1] <= y1 and y1 > 0) or
+				(rect[2] >= x2 - 1 and x2 < w) or (rect[3] >= y2 - 1 and y2 < h))
+
+	def _track(self, images):
+		"""Boxes for the leading ``images`` of the current segment, up to the
+		first tracking loss."""
+		box, roi, thumbnail = self.segment['box'], self.segment['roi'], self.segment['thumbnail']
+		moving = [j for j, image in enumerate(images)
+				if np.abs(self._thumbnail(image, roi) - thumbnail).mean() > self.motion_threshold]
+
+		found = {}
+		if moving:
+			x1, y1, x2, y2 = roi
+			crops = np.array([images[j][y1:y2, x1:x2] for j in moving])
+			self.roi_detections += len(moving)
+			for j, rect in zip(moving, self.detect(crops)):
+				found[j] = None if rect is None else (rect[0] + x1, rect[1] + y1, rect[2] + x1, rect[3] + y1)
+
+		boxes = []
+		for j in range(len(images)):
+			if j not in found:
+				self.propagated += 1
+				boxes.append(box)
+			elif self._lost(found[j]):
+				break
+			else:
+				boxes.append(found[j])
+		return boxes
+
+	def __call__(self, images):
+		boxes = []
+		while len(boxes) < len(images):
+			i = len(boxes)
+			if self.segment is None or self.segment['left'] == 0:
+				boxes.append(self._keyframe(images[i]))
+				continue
+
+			tracked = self._track(images[i:i + self.segment['left']])
+			boxes.extend(tracked)
+			self.segment['left'] -= len(tracked)
+			if len(boxes) < len(images) and self.segment['left'] > 0:
+				# Tracking was lost on the next frame: make it a keyframe.
+				self.segment = None
+		return boxes
@@ -0,0 +1,124 @@
+"""Skips Wav2Lip forward passes that would not change the output.
+
+A mel chunk is silent when its loudest mel frame, averaged over the mel bins,
+is below ``silence_db`` (dB as in audio.melspectrogram, i.e. relative to
+hparams.ref_level_db; digital silence is hparams.min_level_db). Silence starts
+below ``silence_db`` and only ends above ``silence_db + hysteresis_db``, and
+silent runs shorter than ``min_frames`` frames are still rendered, so the mouth
+does not flicker between the generated and the filled-in face around short
+pauses. Silent frames keep the original frame (``fill='original'``) or repeat
+the last prediction (``fill='previous'``).
+
+With ``skip_repeats``, a frame whose mel chunk and face input both differ from
+those of the last rendered frame by less than ``mel_threshold`` and
+``face_threshold`` (mean absolute difference, the face compared at a quarter
+of its size) reuses that prediction. This mostly applies to static images.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+import audio
+
+def chunk_levels_db(mel_chunks):
+	"""Loudness in dB of (N, 1, 80, T) normalized mel chunks: the maximum over
+	the T frames of each frame's mean over the mel bins."""
+	db = audio._denormalize(np.asarray(mel_chunks, dtype=np.float64))
+	return db.mean(axis=2).max(axis=-1).reshape(len(db))
+
+def silent_chunks(mel_chunks, silence_db=-65., hysteresis_db=6., min_frames=5):
+	"""Boolean mask of the silent chunks, with hysteresis and a minimum run length."""
+	silent = np.zeros(len(mel_chunks), dtype=bool)
+	state = False
+	for i, level in enumerate(chunk_levels_db(mel_chunks)):
+		state = level < (silence_db + hysteresis_db if state else silence_db)
+		silent[i] = state
+
+	# Runs of silence as [start, end) pairs; render the short ones.
+	edges = np.flatnonzero(np.diff(np.concatenate([[0], silent.view(np.int8), [0]])))
+	for start, end in zip(edges[::2], edges[1::2]):
+		if end - start < min_frames:
+			silent[start:end] = False
+	return silent
+
+class FrameSkipper:
+	"""Runs ``model`` on the rows of each (mel, face) batch that need it, batches
+	being fed in order over the ``mel_chunks`` of one render. Returns the (B, 3,
+	H, W) predictions and a mask of the rows that should show the original frame
+	(their prediction rows are zeros)."""
+
+	def __init__(self, model, mel_chunks, skip_silence=True, silence_db=-65., hysteresis_db=6.,
+				min_frames=5, fill='original', skip_repeats=False, mel_threshold=0.02, face_threshold=0.005):
+		self.model = model
+		if skip_silence:
+			self.silent = silent_chunks(mel_chunks, silence_db, hysteresis_db, min_frames)
+		else:
+			self.silent = np.zeros(len(mel_chunks), dtype=bool)
+		self.fill = fill
+		self.skip_repeats = skip_repeats
+		self.mel_threshold = mel_threshold
+		self.face_threshold = face_threshold
+		self.position = 0
+		self.anchor = None        # (mel, face) inputs of the last rendered frame
+		self.last_pred = None     # and its prediction
+		self.forwards = 0
+		self.silent_skips = 0
+		self.repeat_skips = 0
+
+	def summary(self):
+		total = self.forwards + self.silent_skips + self.repeat_skips
+		return 'Wav2Lip skipped for {} of {} frames ({} silent, {} repeated)'.format(
+			self.silent_skips + self.repeat_skips, total, self.silent_skips, self.repeat_skips)
+
+	def _repeats_anchor(self, mel, face):
+		return (self.anchor is not None and
+				np.abs(mel - self.anchor[0]).mean() < self.mel_threshold and
+				np.abs(face - self.anchor[1]).mean() < self.face_threshold)
+
+	def __call__(self, mel_batch, img_batch):
+		n = len(img_batch)
+		silent = self.silent[self.position:self.position + n]
+		self.position += n
+
+		mels = faces = None
+		if self.skip_repeats:
+			mels = mel_batch.reshape(n, -1).cpu().numpy()
+			faces = F.avg_pool2d(img_batch, 4).reshape(n, -1).cpu().numpy()
+
+		# Where each row's prediction comes from: a row of this batch, the last
+		# prediction of the previous batch (-1) or none (the original frame).
+		source, rows = [None] * n, []
+		anchor = -1 if self.last_pred is not None else None
+		for j in range(n):
+			if silent[j]:
+				self.silent_skips += 1
+				source[j] = anchor if self.fill == 'previous' else None
+			elif self.skip_repeats and self._repeats_anchor(mels[j], faces[j]):
+				self.repeat_skips += 1
+				source[j] = anchor
+			else:
+				rows.append(j)
+				source[j] = anchor = j
+				if self.skip_repeats:
+					self.anchor = (mels[j], faces[j])
+
+		original = np.array([s is None for s in source])
+		if rows:
+			computed = self.model(mel_batch[rows], img_batch[rows])
+			template = computed[0]
+		elif self.last_pred is not None:
+			template = self.last_pred
+		else:
+			return None, original
+		self.forwards += len(rows)
+
+		pred = torch.zeros((n,) + template.shape, dtype=template.dtype, device=template.device)
+		if rows:
+			pred[rows] = computed
+		for j, s in enumerate(source):
+			if s == -1:
+				pred[j] = self.last_pred
+			elif s is not None and s != j:
+				pred[j] = pred[s]
+		if anchor is not None and anchor >= 0:
+			self.last_pred = pred[anchor].clone()
+		return pred, original
@@ -0,0 +1,118 @@
+import os, tempfile
+import numpy as np
+
+class FrameStore:
+	"""Fixed-shape uint8 frame buffer with a RAM budget.
+
+	The first ``ram_budget // frame size`` frames live in an ordinary (N, H, W, C)
+	ndarray; the frames beyond them are appended to an ``np.memmap`` in
+	``spill_dir``, so resident memory stays bounded no matter how long the source
+	video is while the frames that fit stay in RAM. Supports ``len``, integer
+	indexing (including the ``i % len(frames)`` looping done by ``datagen``),
+	slicing (a copy when the slice spans both parts) and ``truncate``.
+	"""
+
+	def __init__(self, frame_shape, capacity=1, ram_budget=2 << 30, spill_dir=None):
+		self.frame_shape = tuple(frame_shape)
+		self.frame_bytes = int(np.prod(self.frame_shape))
+		self.ram_budget = ram_budget
+		self.spill_dir = spill_dir
+		self.ram_frames = max(1, ram_budget // self.frame_bytes)
+		self._path = None
+		self._len = 0
+		capacity = max(1, int(capacity))
+		self._ram = np.empty((min(capacity, self.ram_frames),) + self.frame_shape, dtype=np.uint8)
+		self._disk = self._map(capacity - self.ram_frames) if capacity > self.ram_frames else None
+
+	@classmethod
+	def from_frames(cls, frames, **kwargs):
+		store = cls(frames[0].shape, capacity=len(frames), **kwargs)
+		for f in frames:
+			store.append(f)
+		return store
+
+	@property
+	def spilled(self):
+		return self._len > self.ram_frames
+
+	@property
+	def nbytes(self):
+		return self._len * self.frame_bytes
+
+	def _map(self, capacity):
+		if self._path is None:
+			fd, self._path = tempfile.mkstemp(prefix='frames_', suffix='.u8', dir=self.spill_dir)
+			os.close(fd)
+		mode = 'r+' if os.path.getsize(self._path) else 'w+'
+		return np.memmap(self._path, dtype=np.uint8, mode=mode, shape=(capacity,) + self.frame_shape)
+
+	def _grow(self):
+		if len(self._ram) < self.ram_frames:
+			new = np.empty((min(2 * len(self._ram), self.ram_frames),) + self.frame_shape, dtype=np.uint8)
+			new[:self._len] = self._ram[:self._len]
+			self._ram = new
+		else:
+			# Remapping the same file to a larger size keeps the frames already in it.
+			capacity = 2 * len(self._disk) if self._disk is not None else len(self._ram)
+			if self._disk is not None:
+				self._disk.flush()
+			self._disk = self._map(capacity)
+
+	def _capacity(self):
+		return len(self._ram) + (len(self._disk) if self._disk is not None else 0)
+
+	def append(self, frame):
+		if frame.shape != self.frame_shape:
+			raise ValueError('Frame shape {} does not match store shape {}'.format(frame.shape, self.frame_shape))
+		if self._len == self._capacity():
+			self._grow()
+		self._frame(self._len)[...] = frame
+		self._len += 1
+
+	def _frame(self, idx):
+		if idx < self.ram_frames:
+			return self._ram[idx]
+		return self._disk[idx - self.ram_frames]
+
+	def truncate(self, n):
+		self._len = min(self._len, n)
+
+	def __len__(self):
+		return self._len
+
+	def __getitem__(self, idx):
+		if isinstance(idx, slice):
+			start, stop, step = idx.indices(self._len)
+			if step == 1 and stop <= self.ram_frames:
+				return self._ram[start:max(start, stop)]
+			if step == 1 and start >= self.ram_frames:
+				return self._disk[start - self.ram_frames:max(start, stop) - self.ram_frames]
+			indices = range(start, stop, step)
+			out = np.empty((len(indices),) + self.frame_shape, dtype=np.uint8)
+			for j, i in enumerate(indices):
+				out[j] = self._frame(i)
+			return out
+		if idx < 0:
+			idx += self._len
+		if not 0 <= idx < self._len:
+			raise IndexError('frame index {} out of range'.format(idx))
+		return self._frame(idx)
+
+	def __iter__(self):
+		for i in range(self._len):
+			yield self._frame(i)
+
+	def _release_file(self):
+		if self._path is not None and os.path.exists(self._path):
+			os.remove(self._path)
+		self._path = None
+
+	def close(self):
+		self._ram = self._disk = None
+		self._release_file()
+
+	def __del__(self):
+		try:
+			self.close()
+		except Exception:
+			pass
@@ -1,13 +1,22 @@
 from os import listdir, path
 import numpy as np
-import scipy, cv2, os, sys, argparse, audio
+import cv2, os, sys, argparse
 import json, subprocess, random, string
-from tqdm import tqdm
 from glob import glob
-import torch, face_detection
-from models import Wav2Lip
+from itertools import chain, islice
+from frame_store import FrameStore
+from detection_cache import DetectionCache
+from pipeline import run_pipeline, format_report
+from video_writer import FFmpegWriter
+from face_tracker import KeyframeTracker
+from smoothing import MovingAverage, Exponential, OneEuro
+from model_registry import registry
 import platform
 
+# torch, librosa (audio.py), tqdm, face_detection and the models are imported in
+# the functions that use them, so that importing this module, --help and
+# argument errors stay fast. startup_benchmark.py checks this.
+
 parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
 
 parser.add_argument('--checkpoint_path', type=str, 
@@ -29,8 +38,11 @@ parser.add_argument('--pads', nargs='+', type=int, default=[0, 10, 0, 0],
 					help='Padding (top, bottom, left, right). Please adjust to include chin at least')
 
 parser.add_argument('--face_det_batch_size', type=int, 
-					help='Batch size for face detection', default=16)
-parser.add_argument('--wav2lip_batch_size', type=int, help='Batch size for Wav2Lip model(s)', default=128)
+					help='Batch size for face detection (default: picked from free memory and frame size)', default=None)
+parser.add_argument('--wav2lip_batch_size', type=int, 
+					help='Batch size for Wav2Lip model(s) (default: picked from free memory)', default=None)
+parser.add_argument('--batch_memory_budget', type=int, default=None,
+					help='Memory budget (in MB) used to pick batch sizes (default: half of the free memory)')
 
 parser.add_argument('--resize_factor', default=1, type=int, 
 			help='Reduce the resolution by this factor. Sometimes, best results are obtained at 480p or 720p')
@@ -49,46 +61,204 @@ parser.add_argument('--rotate', default=False, action='store_true',
 
 parser.add_argument('--nosmooth', default=False, action='store_true',
 					help='Prevent smoothing face detections over a short temporal window')
-
-args = parser.parse_args()
-args.img_size = 96
-
-if os.path.isfile(args.face) and args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-	args.static = True
-
-def get_smoothened_boxes(boxes, T):
-	for i in range(len(boxes)):
-		if i + T > len(boxes):
-			window = boxes[len(boxes) - T:]
-		else:
-			window = boxes[i : i + T]
-		boxes[i] = np.mean(window, axis=0)
-	return boxes
-
-def face_detect(images):
-	detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
-											flip_input=False, device=device)
-
-	batch_size = args.face_det_batch_size
-	
-	while 1:
-		predictions = []
-		try:
-			for i in tqdm(range(0, len(images), batch_size)):
-				predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
-		except RuntimeError:
-			if batch_size == 1: 
-				raise RuntimeError('Image too big to run face detection on GPU. Please use the --resize_factor argument')
-			batch_size //= 2
-			print('Recovering from OOM error; New batch size: {}'.format(batch_size))
-			continue
-		break
-
+parser.add_argument('--smoothing', default='mean', choices=['mean', 'ema', 'one_euro'],
+					help='Filter used to smooth face detections over time: a moving average over the next '
+					'--smooth_window frames, an exponential moving average or a one-euro filter')
+parser.add_argument('--smooth_window', default=5, type=int, help='Window of --smoothing mean, in frames')
+parser.add_argument('--ema_alpha', default=0.5, type=float, help='Weight of the current frame for --smoothing ema')
+parser.add_argument('--one_euro_min_cutoff', default=1., type=float,
+					help='Cutoff frequency (Hz) of --smoothing one_euro for a still face; lower smooths more')
+parser.add_argument('--one_euro_beta', default=0.01, type=float,
+					help='Increase of that cutoff per pixel/second of face motion; higher lags less')
+
+parser.add_argument('--frame_ram_budget', default=2048, type=int,
+					help='RAM budget (in MB) for decoded frames. Frames beyond it are spilled to a memory-mapped file in --temp_dir')
+
+parser.add_argument('--face_det_max_side', default=0, type=int,
+					help='Downscale frames so their longer side is at most this for face detection only; '
+					'boxes are mapped back and the output keeps its resolution. 0 detects at full resolution')
+
+parser.add_argument('--keyframe_interval', default=1, type=int,
+					help='Run full-frame face detection only every this many frames (and after tracking losses), '
+					'tracking the face in between. 1 detects on every frame')
+parser.add_argument('--keyframe_roi_pad', default=0.5, type=float,
+					help='Padding of the region searched between keyframes, relative to the face size')
+parser.add_argument('--keyframe_motion', default=4., type=float,
+					help='Mean gray-level change of that region above which the face is re-detected in it')
+
+parser.add_argument('--face_det_cache_dir', default=None, type=str,
+					help='Directory for cached face detections (default: ~/.cache/wav2lip/face_det)')
+parser.add_argument('--face_det_cache_size', default=512, type=int,
+					help='Size limit (in MB) of the face detection cache. 0 disables the cache')
+
+parser.add_argument('--pipeline', default=False, action='store_true',
+					help='Overlap decoding/face detection, Wav2Lip inference and compositing in separate threads')
+parser.add_argument('--pipeline_queue', default=2, type=int,
+					help='Number of batches buffered between pipeline stages')
+
+parser.add_argument('--encoder', default='ffmpeg', choices=['ffmpeg', 'opencv'],
+					help='ffmpeg: pipe frames to a single ffmpeg process that also muxes the audio. '
+					'opencv: write temp/result.avi with cv2.VideoWriter and mux it in a second ffmpeg pass')
+parser.add_argument('--vcodec', default='libx264', type=str, help='ffmpeg video encoder used by --encoder ffmpeg')
+parser.add_argument('--preset', default='medium', type=str, help='Encoder preset used by --encoder ffmpeg')
+parser.add_argument('--crf', default=18, type=int, help='Constant rate factor used by --encoder ffmpeg')
+parser.add_argument('--encoder_threads', default=0, type=int,
+					help='Encoder threads used by --encoder ffmpeg (0: let ffmpeg decide)')
+
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'int8'],
+					help='bf16 runs both models in bfloat16 / channels_last on CPUs that support it (fp32 elsewhere); '
+					'int8 runs the CPU-quantized Wav2Lip and S3FD models written by quantize_models.py')
+parser.add_argument('--backend', default='torch', choices=['torch', 'onnxruntime'],
+					help='onnxruntime runs the Wav2Lip and S3FD ONNX models written by export_onnx.py on CPU. '
+					'Only the forward passes: torch is still required for the rest of the pipeline')
+
+parser.add_argument('--model_cache_size', default=2048, type=int,
+					help='Upper limit in MB for the weights of the models kept loaded in this process. '
+					'The least recently used models are unloaded beyond it')
+parser.add_argument('--face_feature_cache_size', default=256, type=int,
+					help='MB of face encoder features kept for reuse across repeated source frames '
+					'(static images, looped videos). Applies to regular fp32 checkpoints; 0 disables')
+parser.add_argument('--skip_silence', default=False, action='store_true',
+					help='Skip Wav2Lip on silent audio (pauses between sentences) and show --silence_fill instead')
+parser.add_argument('--silence_db', default=-65., type=float,
+					help='Mel level in dB (see audio.melspectrogram) below which a frame counts as silent')
+parser.add_argument('--silence_min_frames', default=5, type=int,
+					help='Shortest silence, in frames, to skip; shorter pauses are rendered')
+parser.add_argument('--silence_fill', default='original', choices=['original', 'previous'],
+					help='Show the original frame or repeat the last prediction on silent frames')
+parser.add_argument('--skip_repeats', default=False, action='store_true',
+					help='Reuse the last prediction when both the mel chunk and the face are near-identical to its inputs')
+
+parser.add_argument('--temp_dir', default='temp', type=str,
+					help='Directory for intermediate files. Concurrent renders must each use their own')
+
+args = None
+
+def parse_args(argv=None):
+	args = parser.parse_args(argv)
+	args.img_size = 96
+
+	if os.path.isfile(args.face) and args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
+		args.static = True
+	return args
+
+def make_smoother():
+	if args.smoothing == 'mean':
+		return MovingAverage(args.smooth_window)
+	if args.smoothing == 'ema':
+		return Exponential(args.ema_alpha)
+	return OneEuro(args.fps, args.one_euro_min_cutoff, args.one_euro_beta)
+
+def is_out_of_memory(e):
+	"""Whether a RuntimeError is a CUDA or CPU allocation failure, which a smaller
+	batch may avoid, rather than a bug."""
+	import torch
+
+	if isinstance(e, getattr(torch.cuda, 'OutOfMemoryError', ())):
+		return True
+	message = str(e).lower()
+	return any(m in message for m in ('out of memory', "can't allocate memory", 'failed to allocate memory'))
+
+def recover_from_oom(batch_size, message):
+	import torch
+
+	if batch_size == 1: 
+		raise RuntimeError(message)
+	if 'cuda' in get_device():
+		torch.cuda.empty_cache()
+	batch_size //= 2
+	print('Recovering from OOM error; New batch size: {}'.format(batch_size))
+	return batch_size
+
+def detection_shape(frame_shape):
+	"""Shape of the frames as the detector sees them with --face_det_max_side."""
+	h, w = frame_shape[:2]
+	scale = min(1., args.face_det_max_side / float(max(h, w))) if args.face_det_max_side > 0 else 1.
+	return (int(round(h * scale)), int(round(w * scale))) + tuple(frame_shape[2:])
+
+def run_detector(images):
+	detector = get_detector(args.precision, args.backend)
+	return detector.get_detections_for_batch(images, max_side=args.face_det_max_side)
+
+def make_tracker():
+	if args.keyframe_interval <= 1:
+		return None
+	return KeyframeTracker(run_detector, interval=args.keyframe_interval,
+						roi_pad=args.keyframe_roi_pad, motion_threshold=args.keyframe_motion)
+
+def detect_faces(images, progress=True, tracker=None):
+	from tqdm import tqdm
+
+	own_tracker = tracker is None
+	if own_tracker:
+		tracker = make_tracker()
+	detect = tracker or run_detector
+
+	# On OOM, halve the batch size and carry on from the failed batch, keeping
+	# the predictions that already finished.
+	batch_size = requested = args.face_det_batch_size
+	predictions = []
+	with tqdm(total=len(images), disable=not progress) as pbar:
+		while len(predictions) < len(images):
+			i = len(predictions)
+			try:
+				found = detect(np.array(images[i:i + batch_size]))
+			except RuntimeError as e:
+				if not is_out_of_memory(e):
+					raise
+				batch_size = recover_from_oom(batch_size, 
+					'Image too big to run face detection on GPU. Please use the --resize_factor argument')
+				continue
+			predictions.extend(found)
+			pbar.update(len(found))
+
+	args.face_det_batch_size = batch_size
+	# Only remember sizes the tuner picked or that ran out of memory, not --face_det_batch_size.
+	if (tuner is not None and (face_det_tuned or batch_size < requested) and
+			len(images) >= batch_size and tracker is None):
+		tuner.record_face_det(detection_shape(images[0].shape), batch_size)
+	if own_tracker and tracker is not None:
+		print(tracker.summary())
+	return predictions
+
+def detection_cache_entry():
+	if args.face_det_cache_size <= 0:
+		return None, None
+
+	cache = DetectionCache(args.face_det_cache_dir, args.face_det_cache_size << 20)
+	params = dict(crop=args.crop, resize_factor=args.resize_factor, rotate=args.rotate)
+	if args.face_det_max_side > 0:
+		params['max_side'] = args.face_det_max_side
+	if args.keyframe_interval > 1:
+		params['keyframes'] = [args.keyframe_interval, args.keyframe_roi_pad, args.keyframe_motion]
+	# bf16, int8 and ONNX Runtime detectors give slightly different boxes than fp32.
+	if args.precision != 'fp32' or args.backend != 'torch':
+		params.update(precision=args.precision, backend=args.backend)
+	return cache, cache.key(args.face, **params)
+
+def cached_detect_faces(images):
+	cache, key = detection_cache_entry()
+	if cache is None:
+		return detect_faces(images)
+
+	cached = cache.get(key)
+	if cached is None:
+		cached = np.zeros((0, 4), dtype=np.int32)
+	if len(cached) >= len(images):
+		print('Using cached face detections')
+		return [tuple(rect) for rect in cached[:len(images)]]
+
+	predictions = [tuple(rect) for rect in cached] + detect_faces(images[len(cached):])
+	if all(rect is not None for rect in predictions):
+		cache.put(key, predictions)
+	return predictions
+
+def pad_boxes(predictions, images):
 	results = []
 	pady1, pady2, padx1, padx2 = args.pads
 	for rect, image in zip(predictions, images):
 		if rect is None:
-			cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
+			cv2.imwrite(os.path.join(args.temp_dir, 'faulty_frame.jpg'), image) # check this frame where the face was not detected.
 			raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
 
 		y1 = max(0, rect[1] - pady1)
@@ -97,17 +267,96 @@ def face_detect(images):
 		x2 = min(image.shape[1], rect[2] + padx2)
 		
 		results.append([x1, y1, x2, y2])
+	return results
 
-	boxes = np.array(results)
-	if not args.nosmooth: boxes = get_smoothened_boxes(boxes, T=5)
+def face_detect(images):
+	predictions = cached_detect_faces(images)
+
+	boxes = np.array(pad_boxes(predictions, images))
+	if not args.nosmooth: boxes = make_smoother()(boxes).astype(np.int64)
 	results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
 
-	del detector
 	return results 
 
-def datagen(frames, mels):
-	img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+def iter_face_coords(frame_chunks):
+	"""Incremental face_detect: detects each chunk of frames as it arrives and yields
+	the (y1, y2, x1, x2) box of every frame once the smoothing window ahead of it is
+	known. Produces the same boxes as face_detect on the concatenated chunks.
+	"""
+	smoother = None if args.nosmooth else make_smoother()
+	lookahead = smoother.lookahead if smoother is not None else 0
+
+	cache, key = detection_cache_entry()
+	cached = cache.get(key) if cache is not None else None
+	if cached is None:
+		cached = np.zeros((0, 4), dtype=np.int32)
+
+	tracker = make_tracker()
+	predictions, boxes, emitted = [], [], 0
+	for chunk in frame_chunks:
+		start = len(predictions)
+		found = [tuple(rect) for rect in cached[start:start + len(chunk)]]
+		if len(found) < len(chunk):
+			found += detect_faces(chunk[len(found):], progress=False, tracker=tracker)
+		predictions.extend(found)
+		boxes.extend(pad_boxes(found, chunk))
+
+		if lookahead == 0:
+			# No smoothing, or a causal filter that carries its state across chunks.
+			new = boxes[emitted:] if smoother is None else smoother(boxes[emitted:]).astype(np.int64)
+			for x1, y1, x2, y2 in new:
+				yield (y1, y2, x1, x2)
+			emitted = len(boxes)
+			continue
+
+		while emitted + lookahead < len(boxes):
+			x1, y1, x2, y2 = np.mean(boxes[emitted:emitted + smoother.window], axis=0).astype(np.int64)
+			yield (y1, y2, x1, x2)
+			emitted += 1
+
+	# The last frames of a moving average share the final window.
+	if emitted < len(boxes):
+		x1, y1, x2, y2 = np.mean(boxes[-smoother.window:], axis=0).astype(np.int64)
+		for _ in range(emitted, len(boxes)):
+			yield (y1, y2, x1, x2)
+
+	if tracker is not None and tracker.keyframes > 0:
+		print(tracker.summary())
+	if cache is not None and len(predictions) > len(cached):
+		cache.put(key, predictions)
+
+def make_batch(img_batch, mel_batch, frame_batch, coords_batch):
+	img_batch = np.asarray(img_batch)
 
+	img_masked = img_batch.copy()
+	img_masked[:, args.img_size//2:] = 0
+
+	img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
+
+	return img_batch, mel_batch, frame_batch, coords_batch
+
+def batch_samples(samples, mels):
+	"""Groups (face, frame, coords) samples, one per mel chunk in order, into batches.
+	Mel batches are slices of the contiguous ``mels`` array, not copies."""
+	img_batch, frame_batch, coords_batch = [], [], []
+	start = 0
+
+	for face, frame, coords in samples:
+		face = cv2.resize(face, (args.img_size, args.img_size))
+			
+		img_batch.append(face)
+		frame_batch.append(frame)
+		coords_batch.append(coords)
+
+		if len(img_batch) >= args.wav2lip_batch_size:
+			yield make_batch(img_batch, mels[start:start + len(img_batch)], frame_batch, coords_batch)
+			start += len(img_batch)
+			img_batch, frame_batch, coords_batch = [], [], []
+
+	if len(img_batch) > 0:
+		yield make_batch(img_batch, mels[start:start + len(img_batch)], frame_batch, coords_batch)
+
+def datagen(frames, mels):
 	if args.box[0] == -1:
 		if not args.static:
 			face_det_results = face_detect(frames) # BGR2RGB for CNN face detection
@@ -118,108 +367,314 @@ def datagen(frames, mels):
 		y1, y2, x1, x2 = args.box
 		face_det_results = [[f[y1: y2, x1:x2], (y1, y2, x1, x2)] for f in frames]
 
-	for i, m in enumerate(mels):
-		idx = 0 if args.static else i%len(frames)
-		frame_to_save = frames[idx].copy()
-		face, coords = face_det_results[idx].copy()
-
-		face = cv2.resize(face, (args.img_size, args.img_size))
-			
-		img_batch.append(face)
-		mel_batch.append(m)
-		frame_batch.append(frame_to_save)
-		coords_batch.append(coords)
-
-		if len(img_batch) >= args.wav2lip_batch_size:
-			img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+	def samples():
+		for i in range(len(mels)):
+			idx = 0 if args.static else i%len(frames)
+			face, coords = face_det_results[idx]
+			yield face, frames[idx], coords
+
+	yield from batch_samples(samples(), mels)
+
+def iter_chunks(iterable, size):
+	chunk = []
+	for x in iterable:
+		chunk.append(x)
+		if len(chunk) == size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def stream_datagen(frame_iter, frames, mels):
+	"""datagen for --pipeline: decodes and detects faces on the fly, appending the
+	decoded frames to the ``frames`` store, so batches flow before the whole video
+	has been read."""
+	def stored(chunks):
+		for chunk in chunks:
+			for f in chunk:
+				frames.append(f)
+			yield chunk
+
+	coords_iter = iter_face_coords(stored(iter_chunks(islice(frame_iter, len(mels)), args.face_det_batch_size)))
+	face_coords = []
+
+	def samples():
+		nonlocal coords_iter
+		for i in range(len(mels)):
+			if coords_iter is not None:
+				try:
+					face_coords.append(next(coords_iter))
+				except StopIteration:
+					coords_iter = None
+					if len(face_coords) == 0:
+						raise ValueError('Could not read any frames from {}'.format(args.face))
+
+			idx = i if coords_iter is not None else i%len(face_coords)
+			y1, y2, x1, x2 = face_coords[idx]
+			yield frames[idx][y1: y2, x1:x2], frames[idx], (y1, y2, x1, x2)
+
+	yield from batch_samples(samples(), mels)
+
+def resize_faces(pred, coords):
+	"""Resizes a batch of (B, 3, H, W) predictions in [0, 1] to their face boxes.
+
+	All faces are resampled by one grid_sample call (bilinear, sampling like
+	interpolate with align_corners=False) into a canvas of the largest box,
+	converted to uint8 and copied to the host once; each face is then a crop of
+	it. Returns a list of (h, w, 3) uint8 arrays in batch order.
+	"""
+	import torch
+	import torch.nn.functional as F
+
+	sizes = torch.tensor([(y2 - y1, x2 - x1) for y1, y2, x1, x2 in coords], dtype=torch.float32)
+	max_h, max_w = (int(v) for v in sizes.max(dim=0).values)
+
+	# Output pixel x of a face w wide samples the input at (2x + 1) / w - 1 in
+	# grid_sample's [-1, 1] coordinates; pixels beyond the face are cropped off.
+	gx = (2 * torch.arange(max_w, dtype=torch.float32) + 1) / sizes[:, 1:] - 1
+	gy = (2 * torch.arange(max_h, dtype=torch.float32) + 1) / sizes[:, :1] - 1
+	grid = torch.stack([gx[:, None, :].expand(-1, max_h, -1), gy[:, :, None].expand(-1, -1, max_w)], dim=-1)
+
+	resized = F.grid_sample(pred.float(), grid.to(pred.device), mode='bilinear',
+							padding_mode='border', align_corners=False)
+	canvas = (resized * 255.).clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+	return [face[:int(h), :int(w)] for face, (h, w) in zip(canvas, sizes.tolist())]
+
+def batch_to_tensors(img_batch, mel_batch):
+	import torch
+
+	img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(get_device())
+	mel_batch = torch.from_numpy(mel_batch).to(get_device())
+	return img_batch, mel_batch
+
+def run_model(model, mel_batch, img_batch):
+	"""Runs Wav2Lip in sub-batches of --wav2lip_batch_size, halving it (for this and
+	all later batches) when a forward pass runs out of memory."""
+	import torch
+
+	preds = []
+	while sum(len(p) for p in preds) < len(img_batch):
+		i = sum(len(p) for p in preds)
+		batch_size = args.wav2lip_batch_size
+		try:
+			preds.append(model(mel_batch[i:i + batch_size], img_batch[i:i + batch_size]))
+		except RuntimeError as e:
+			if not is_out_of_memory(e):
+				raise
+			args.wav2lip_batch_size = recover_from_oom(batch_size, 'Out of memory running Wav2Lip with batch size 1')
+	return preds[0] if len(preds) == 1 else torch.cat(preds)
 
-			img_masked = img_batch.copy()
-			img_masked[:, args.img_size//2:] = 0
+mel_step_size = 16
+tuner = None
+face_det_tuned = False
 
-			img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-			mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+def get_mel_chunks(mel, fps):
+	"""Cuts the (80, T) mel into one mel_step_size window per video frame.
 
-			yield img_batch, mel_batch, frame_batch, coords_batch
-			img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+	Returns a contiguous (N, 1, 80, mel_step_size) float32 array gathered from a
+	strided view of the mel; the last window is aligned to the end of the mel.
+	"""
+	T = mel.shape[1]
+	if T < mel_step_size:
+		raise ValueError('Audio is too short: need at least {} mel frames, got {}'.format(mel_step_size, T))
 
-	if len(img_batch) > 0:
-		img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+	mel_idx_multiplier = 80./fps
+	starts = (np.arange(int(T / mel_idx_multiplier) + 2) * mel_idx_multiplier).astype(np.int64)
+	starts = np.append(starts[starts + mel_step_size <= T], T - mel_step_size)
 
-		img_masked = img_batch.copy()
-		img_masked[:, args.img_size//2:] = 0
+	windows = np.lib.stride_tricks.sliding_window_view(mel.astype(np.float32), mel_step_size, axis=1)
+	return np.ascontiguousarray(windows.transpose(1, 0, 2)[starts][:, None])
 
-		img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-		mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+# Set by the first call to get_device.
+device = None
 
-		yield img_batch, mel_batch, frame_batch, coords_batch
+def get_device():
+	global device
+	if device is None:
+		import torch
 
-mel_step_size = 16
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-print('Using {} for inference.'.format(device))
+		device = 'cuda' if torch.cuda.is_available() else 'cpu'
+		print('Using {} for inference.'.format(device))
+	return device
 
 def _load(checkpoint_path):
-	if device == 'cuda':
+	import torch
+
+	if get_device() == 'cuda':
 		checkpoint = torch.load(checkpoint_path)
 	else:
 		checkpoint = torch.load(checkpoint_path,
 								map_location=lambda storage, loc: storage)
 	return checkpoint
 
-def load_model(path):
-	model = Wav2Lip()
+def load_model(path, model_class=None):
+	import torch
+	from face_detection.utils import is_torchscript, is_weights_file, load_weights
+	from models import Wav2Lip
+
+	device = get_device()
+	if is_torchscript(path):
+		print("Load TorchScript model from: {}".format(path))
+		return torch.jit.optimize_for_inference(torch.jit.load(path, map_location=device).eval())
+
+	model = (model_class or Wav2Lip)()
 	print("Load checkpoint from: {}".format(path))
-	checkpoint = _load(path)
-	s = checkpoint["state_dict"]
-	new_s = {}
-	for k, v in s.items():
-		new_s[k.replace('module.', '')] = v
-	model.load_state_dict(new_s)
+	if is_weights_file(path):
+		# Written by convert_checkpoint.py: names are already normalized and any
+		# float16 weights are cast back by load_state_dict's copy.
+		model.load_state_dict(load_weights(path)[0])
+	else:
+		checkpoint = _load(path)
+		s = checkpoint["state_dict"]
+		new_s = {}
+		for k, v in s.items():
+			new_s[k.replace('module.', '')] = v
+		model.load_state_dict(new_s)
 
 	model = model.to(device)
 	return model.eval()
 
+# Loaded models are kept in model_registry.registry, so that every render in a
+# long-running process (render_server.py) reuses them.
+
+# Set by render_server.py --batch_jobs to the client of its batch scheduler,
+# which then runs Wav2Lip for every job instead of the model loaded here.
+shared_model = None
+
+_S3FD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'face_detection', 'detection', 'sfd')
+S3FD_INT8_PATH = os.path.join(_S3FD_DIR, 's3fd_int8.ts')
+S3FD_ONNX_PATH = os.path.join(_S3FD_DIR, 's3fd.onnx')
+S3FD_WEIGHTS_PATH = os.path.join(_S3FD_DIR, 's3fd.safetensors')
+
+def int8_checkpoint_path(path):
+	return os.path.splitext(path)[0] + '_int8.ts'
+
+def onnx_checkpoint_path(path):
+	return os.path.splitext(path)[0] + '.onnx'
+
+def _check_cpu_model(path, option, script):
+	if not os.path.isfile(path):
+		raise FileNotFoundError('{} not found. Create it for {} with {} first'.format(path, option, script))
+	if get_device() != 'cpu':
+		raise ValueError('{} is only supported on CPU'.format(option))
+	return path
+
+def _exported_model(precision, backend, int8_path, onnx_path):
+	"""Returns the exported model file selected by --precision and --backend, or
+	None to use the regular checkpoint."""
+	if backend == 'onnxruntime':
+		if precision != 'fp32':
+			raise ValueError('--backend onnxruntime only runs the fp32 ONNX export')
+		return _check_cpu_model(onnx_path, '--backend onnxruntime', 'export_onnx.py')
+	if precision == 'int8':
+		return _check_cpu_model(int8_path, '--precision int8', 'quantize_models.py')
+	return None
+
+def get_model(path, precision='fp32', backend='torch'):
+	import torch
+	from face_detection.utils import is_torchscript, OnnxModule, to_bf16
+
+	device = get_device()
+
+	def load():
+		model_file = _exported_model(precision, backend, int8_checkpoint_path(path), onnx_checkpoint_path(path))
+		if backend == 'onnxruntime':
+			print("Load ONNX model from: {}".format(model_file))
+			return OnnxModule(model_file, torch.get_num_threads())
+		if precision == 'bf16':
+			if is_torchscript(path):
+				raise ValueError('--precision bf16 needs a regular checkpoint, not a TorchScript export')
+			return to_bf16(load_model(path), (torch.randn(2, 1, 80, 16, device=device),
+											torch.rand(2, 6, 96, 96, device=device)), name='Wav2Lip')
+		return load_model(model_file or path)
+
+	return registry.get(('wav2lip', path, device, precision, backend), load)
+
+def get_detector(precision='fp32', backend='torch'):
+	import face_detection
+
+	device = get_device()
+	model_file = _exported_model(precision, backend, S3FD_INT8_PATH, S3FD_ONNX_PATH)
+	if model_file is None and os.path.isfile(S3FD_WEIGHTS_PATH):
+		model_file = S3FD_WEIGHTS_PATH
+
+	def load():
+		kwargs = {'path_to_detector': model_file} if model_file else {}
+		if precision == 'bf16':
+			kwargs['bf16'] = True
+		return face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
+											flip_input=False, device=device, face_detector_kwargs=kwargs)
+
+	return registry.get(('s3fd', model_file, device, precision, backend), load)
+
+def get_syncnet(path):
+	"""The expert lip-sync discriminator (SyncNet_color) of a checkpoint written by
+	color_syncnet_train.py, in eval mode."""
+	from models import SyncNet_color
+
+	return registry.get(('syncnet', path, get_device(), 'fp32', 'torch'),
+						lambda: load_model(path, SyncNet_color))
+
+def iter_video_frames(video_stream):
+	while 1:
+		still_reading, frame = video_stream.read()
+		if not still_reading:
+			video_stream.release()
+			break
+		if args.resize_factor > 1:
+			frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
+
+		if args.rotate:
+			frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
+
+		y1, y2, x1, x2 = args.crop
+		if x2 == -1: x2 = frame.shape[1]
+		if y2 == -1: y2 = frame.shape[0]
+
+		yield frame[y1:y2, x1:x2]
+
 def main():
+	import torch, audio
+	from tqdm import tqdm
+	from models import Wav2Lip
+	from batch_tuner import BatchTuner
+	from face_feature_cache import FaceFeatureCache
+
+	device = get_device()
+	registry.max_bytes = args.model_cache_size << 20 if args.model_cache_size > 0 else None
+	streaming = False
 	if not os.path.isfile(args.face):
 		raise ValueError('--face argument must be a valid path to video/image file')
 
 	elif args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-		full_frames = [cv2.imread(args.face)]
+		full_frames = FrameStore.from_frames([cv2.imread(args.face)])
 		fps = args.fps
 
 	else:
 		video_stream = cv2.VideoCapture(args.face)
 		fps = video_stream.get(cv2.CAP_PROP_FPS)
+		args.fps = fps
+		frame_count = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+
+		frame_iter = iter_video_frames(video_stream)
+		first_frame = next(frame_iter, None)
+		if first_frame is None:
+			raise ValueError('Could not read any frames from {}'.format(args.face))
+		full_frames = FrameStore(first_frame.shape, capacity=frame_count,
+								ram_budget=args.frame_ram_budget << 20, spill_dir=args.temp_dir)
+
+		# With --pipeline, frames are decoded by the first pipeline stage instead.
+		streaming = args.pipeline and not args.static and args.box[0] == -1
+		if streaming:
+			frame_iter = chain([first_frame], frame_iter)
+		else:
+			print('Reading video frames...')
+			full_frames.append(first_frame)
+			for frame in frame_iter:
+				full_frames.append(frame)
 
-		print('Reading video frames...')
-
-		full_frames = []
-		while 1:
-			still_reading, frame = video_stream.read()
-			if not still_reading:
-				video_stream.release()
-				break
-			if args.resize_factor > 1:
-				frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
-
-			if args.rotate:
-				frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
-
-			y1, y2, x1, x2 = args.crop
-			if x2 == -1: x2 = frame.shape[1]
-			if y2 == -1: y2 = frame.shape[0]
-
-			frame = frame[y1:y2, x1:x2]
-
-			full_frames.append(frame)
-
-	print ("Number of frames available for inference: "+str(len(full_frames)))
-
-	if not args.audio.endswith('.wav'):
-		print('Extracting raw audio...')
-		command = 'ffmpeg -y -i {} -strict -2 {}'.format(args.audio, 'temp/temp.wav')
-
-		subprocess.call(command, shell=True)
-		args.audio = 'temp/temp.wav'
+	if not streaming:
+		print ("Number of frames available for inference: "+str(len(full_frames)))
 
 	wav = audio.load_wav(args.audio, 16000)
 	mel = audio.melspectrogram(wav)
@@ -228,53 +683,122 @@ def main():
 	if np.isnan(mel.reshape(-1)).sum() > 0:
 		raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
 
-	mel_chunks = []
-	mel_idx_multiplier = 80./fps 
-	i = 0
-	while 1:
-		start_idx = int(i * mel_idx_multiplier)
-		if start_idx + mel_step_size > len(mel[0]):
-			mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-			break
-		mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-		i += 1
+	mel_chunks = get_mel_chunks(mel, fps)
 
 	print("Length of mel chunks: {}".format(len(mel_chunks)))
 
-	full_frames = full_frames[:len(mel_chunks)]
+	global tuner, face_det_tuned
+	tuner = BatchTuner(device, budget=args.batch_memory_budget << 20 if args.batch_memory_budget else None)
+	face_det_tuned = args.face_det_batch_size is None
+	wav2lip_tuned = args.wav2lip_batch_size is None
+	if face_det_tuned:
+		args.face_det_batch_size = tuner.face_det_batch_size(detection_shape(full_frames.frame_shape))
+	if wav2lip_tuned:
+		args.wav2lip_batch_size = tuner.wav2lip_batch_size()
+	print('Batch sizes: face detection {}, Wav2Lip {}'.format(args.face_det_batch_size, args.wav2lip_batch_size))
 
 	batch_size = args.wav2lip_batch_size
-	gen = datagen(full_frames.copy(), mel_chunks)
-
-	for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, 
-											total=int(np.ceil(float(len(mel_chunks))/batch_size)))):
-		if i == 0:
-			model = load_model(args.checkpoint_path)
-			print ("Model loaded")
-
-			frame_h, frame_w = full_frames[0].shape[:-1]
-			out = cv2.VideoWriter('temp/result.avi', 
-									cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
-
-		img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-		mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+	if streaming:
+		gen = stream_datagen(frame_iter, full_frames, mel_chunks)
+	else:
+		full_frames.truncate(len(mel_chunks))
+		gen = datagen(full_frames, mel_chunks)
 
+	if shared_model is not None:
+		model = shared_model
+	else:
+		model = get_model(args.checkpoint_path, args.precision, args.backend)
+	print ("Model loaded")
+	if args.face_feature_cache_size > 0 and isinstance(model, Wav2Lip):
+		model = FaceFeatureCache(model, args.face_feature_cache_size << 20)
+
+	skipper = None
+	if args.skip_silence or args.skip_repeats:
+		from frame_skipper import FrameSkipper
+		skipper = FrameSkipper(lambda mel, img: run_model(model, mel, img), mel_chunks,
+								skip_silence=args.skip_silence, silence_db=args.silence_db,
+								min_frames=args.silence_min_frames, fill=args.silence_fill,
+								skip_repeats=args.skip_repeats)
+
+	temp_avi = os.path.join(args.temp_dir, 'result.avi')
+	out, canvas = None, None
+
+	def infer(batch):
+		img_batch, mel_batch, frames, coords = batch
+		img_batch, mel_batch = batch_to_tensors(img_batch, mel_batch)
+
+		original = None
 		with torch.no_grad():
-			pred = model(mel_batch, img_batch)
-
-		pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-		
-		for p, f, c in zip(pred, frames, coords):
+			if skipper is None:
+				pred = run_model(model, mel_batch, img_batch)
+			else:
+				pred, original = skipper(mel_batch, img_batch)
+
+		return pred, frames, coords, original
+
+	def composite(batch):
+		nonlocal out, canvas
+		pred, frames, coords, original = batch
+		if out is None:
+			frame_h, frame_w = frames[0].shape[:-1]
+			if args.encoder == 'ffmpeg':
+				out = FFmpegWriter(args.outfile, fps, (frame_w, frame_h), audio_path=args.audio,
+								vcodec=args.vcodec, preset=args.preset, crf=args.crf, threads=args.encoder_threads)
+			else:
+				out = cv2.VideoWriter(temp_avi, 
+										cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
+			canvas = np.empty_like(frames[0])
+
+		# Frames skipped by --skip_silence keep their original face.
+		rendered = list(range(len(frames)) if original is None else np.flatnonzero(~original))
+		faces = {}
+		if rendered:
+			if len(rendered) < len(frames):
+				pred = pred[rendered]
+			with torch.no_grad():
+				faces = dict(zip(rendered, resize_faces(pred, [coords[i] for i in rendered])))
+
+		# Source frames are shared with the frame store, so each one is composited
+		# into a reused canvas instead of being copied per frame.
+		for i, (f, c) in enumerate(zip(frames, coords)):
 			y1, y2, x1, x2 = c
-			p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-
-			f[y1:y2, x1:x2] = p
-			out.write(f)
-
-	out.release()
-
-	command = 'ffmpeg -y -i {} -i {} -strict -2 -q:v 1 {}'.format(args.audio, 'temp/result.avi', args.outfile)
-	subprocess.call(command, shell=platform.system() != 'Windows')
+			canvas[:] = f
+			if i in faces:
+				canvas[y1:y2, x1:x2] = faces[i]
+			out.write(canvas)
+
+	# A failed render must not leave ffmpeg running or a partial --outfile behind.
+	try:
+		gen = tqdm(gen, total=int(np.ceil(float(len(mel_chunks))/batch_size)))
+		if args.pipeline:
+			wall, stats = run_pipeline(gen, [('infer', infer), ('composite', composite)],
+										maxsize=args.pipeline_queue)
+			print(format_report(wall, stats))
+		else:
+			for batch in gen:
+				composite(infer(batch))
+
+		out.release()
+	except BaseException:
+		if isinstance(out, FFmpegWriter):
+			out.abort()
+		elif out is not None:
+			out.release()
+		raise
+	finally:
+		full_frames.close()
+
+	if skipper is not None:
+		print(skipper.summary())
+	if isinstance(model, FaceFeatureCache):
+		print('Face encoder skipped for {} of {} frames'.format(model.hits, model.hits + model.misses))
+	if (wav2lip_tuned or args.wav2lip_batch_size < batch_size) and len(mel_chunks) >= args.wav2lip_batch_size:
+		tuner.record_wav2lip(args.wav2lip_batch_size)
+
+	if args.encoder == 'opencv':
+		command = 'ffmpeg -y -i {} -i {} -strict -2 -q:v 1 {}'.format(args.audio, temp_avi, args.outfile)
+		subprocess.call(command, shell=platform.system() != 'Windows')
 
 if __name__ == '__main__':
+	args = parse_args()
 	main()
@@ -0,0 +1,82 @@
+"""Process-wide cache of loaded models.
+
+Models are loaded on first use and kept under a key such as
+('wav2lip', checkpoint, device, precision, backend), so every caller in the
+process (one render after another, render_server.py workers, export scripts,
+tests) shares the warm copy. The total size of the weights is kept under
+``max_bytes`` by dropping the least recently used models; a model that is still
+referenced elsewhere stays usable there and is only reloaded on its next get.
+"""
+import collections, threading
+
+def model_bytes(model, depth=2):
+	"""Bytes held by the weights of ``model``: a torch module (TorchScript
+	included), an object with an ``nbytes`` attribute such as OnnxModule, or an
+	object holding either up to ``depth`` attributes down (FaceAlignment)."""
+	import torch
+
+	if isinstance(model, torch.nn.Module):
+		tensors = {t.data_ptr(): t.nbytes for t in model.state_dict(keep_vars=True).values()
+					if torch.is_tensor(t)}
+		return sum(tensors.values())
+	if hasattr(model, 'nbytes'):
+		return model.nbytes
+	if depth > 0 and hasattr(model, '__dict__'):
+		return sum(model_bytes(v, depth - 1) for v in vars(model).values())
+	return 0
+
+class ModelRegistry:
+	def __init__(self, max_bytes=None):
+		self.max_bytes = max_bytes
+		self.models = collections.OrderedDict()
+		self.sizes = {}
+		self.lock = threading.RLock()
+		self.loads = 0
+		self.evictions = 0
+
+	@property
+	def nbytes(self):
+		return sum(self.sizes.values())
+
+	def __contains__(self, key):
+		return key in self.models
+
+	def __len__(self):
+		return len(self.models)
+
+	def get(self, key, load):
+		"""Returns the model under ``key``, calling ``load()`` to create it if it
+		is not loaded. Other models may be evicted to stay under max_bytes."""
+		with self.lock:
+			if key in self.models:
+				self.models.move_to_end(key)
+			else:
+				model = load()
+				self.models[key] = model
+				self.sizes[key] = model_bytes(model)
+				self.loads += 1
+			self._evict(keep=key)
+			return self.models[key]
+
+	def evict(self, key):
+		with self.lock:
+			if key in self.models:
+				del self.models[key], self.sizes[key]
+				self.evictions += 1
+
+	def clear(self):
+		with self.lock:
+			for key in list(self.models):
+				self.evict(key)
+
+	def _evict(self, keep):
+		if self.max_bytes is None:
+			return
+		for key in list(self.models):
+			if self.nbytes <= self.max_bytes:
+				break
+			if key != keep:
+				print('Unloading {} to stay within the model cache size'.format(key[:2]))
+				self.evict(key)
+
+registry = ModelRegistry()
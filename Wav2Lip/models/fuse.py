@@ -0,0 +1,68 @@
+import copy
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from .conv import Conv2d, Conv2dTranspose
+
+class FusedConv2d(nn.Module):
+    """Inference-only form of conv.Conv2d with its BatchNorm folded into the conv."""
+    def __init__(self, conv, residual):
+        super().__init__()
+        self.conv = conv
+        self.residual = residual
+
+    def forward(self, x):
+        out = self.conv(x)
+        if self.residual:
+            out = out + x
+        return F.relu(out)
+
+class FusedConv2dTranspose(nn.Module):
+    """Inference-only form of conv.Conv2dTranspose with its BatchNorm folded in."""
+    def __init__(self, conv):
+        super().__init__()
+        self.conv = conv
+
+    def forward(self, x):
+        return F.relu(self.conv(x))
+
+def _bn_scale_shift(bn):
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale, shift
+
+@torch.no_grad()
+def fold_conv_bn(conv, bn):
+    """Returns a copy of ``conv`` (Conv2d or ConvTranspose2d) with eval-mode ``bn`` folded in."""
+    fused = copy.deepcopy(conv)
+    scale, shift = _bn_scale_shift(bn)
+    # Output channels are dim 0 of a Conv2d weight and dim 1 of a ConvTranspose2d weight.
+    shape = [1, -1, 1, 1] if isinstance(conv, nn.ConvTranspose2d) else [-1, 1, 1, 1]
+    fused.weight.mul_(scale.view(shape))
+
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.bias = nn.Parameter(bias * scale + shift)
+    return fused
+
+def fuse_model(model):
+    """Returns an eval-mode copy of ``model`` (Wav2Lip, SyncNet_color, ...) in which
+    every conv.Conv2d and conv.Conv2dTranspose block has its BatchNorm folded into
+    the convolution. The residual add and ReLU stay in the fused block's forward so
+    TorchScript can fuse them further.
+    """
+    model = copy.deepcopy(model).eval()
+
+    def replace(module):
+        for name, child in module.named_children():
+            if isinstance(child, Conv2d):
+                conv, bn = child.conv_block
+                setattr(module, name, FusedConv2d(fold_conv_bn(conv, bn), child.residual))
+            elif isinstance(child, Conv2dTranspose):
+                conv, bn = child.conv_block
+                setattr(module, name, FusedConv2dTranspose(fold_conv_bn(conv, bn)))
+            else:
+                replace(child)
+
+    replace(model)
+    return model
@@ -84,36 +84,45 @@ class Wav2Lip(nn.Module):
             nn.Conv2d(32, 3, kernel_size=1, stride=1, padding=0),
             nn.Sigmoid()) 
 
-    def forward(self, audio_sequences, face_sequences):
-        # audio_sequences = (B, T, 1, 80, 16)
-        B = audio_sequences.size(0)
-
-        input_dim_size = len(face_sequences.size())
-        if input_dim_size > 4:
-            audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
-            face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
-
-        audio_embedding = self.audio_encoder(audio_sequences) # B, 512, 1, 1
-
+    def encode_audio(self, audio_sequences):
+        """(B, 1, 80, 16) mel chunks -> (B, 512, 1, 1) audio embeddings."""
+        return self.audio_encoder(audio_sequences)
+
+    def encode_face(self, face_sequences):
+        """(B, 6, 96, 96) masked + reference faces -> list of the face encoder's
+        skip features, shallowest first. They depend only on the faces, so they
+        can be reused for any audio."""
         feats = []
         x = face_sequences
         for f in self.face_encoder_blocks:
             x = f(x)
             feats.append(x)
+        return feats
 
+    def decode(self, audio_embedding, feats):
+        """Audio embeddings and face encoder features -> (B, 3, 96, 96) faces."""
         x = audio_embedding
-        for f in self.face_decoder_blocks:
+        for f, feat in zip(self.face_decoder_blocks, reversed(feats)):
             x = f(x)
             try:
-                x = torch.cat((x, feats[-1]), dim=1)
+                x = torch.cat((x, feat), dim=1)
             except Exception as e:
                 print(x.size())
-                print(feats[-1].size())
+                print(feat.size())
                 raise e
-            
-            feats.pop()
 
-        x = self.output_block(x)
+        return self.output_block(x)
+
+    def forward(self, audio_sequences, face_sequences):
+        # audio_sequences = (B, T, 1, 80, 16)
+        B = audio_sequences.size(0)
+
+        input_dim_size = len(face_sequences.size())
+        if input_dim_size > 4:
+            audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
+            face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
+
+        x = self.decode(self.encode_audio(audio_sequences), self.encode_face(face_sequences))
 
         if input_dim_size > 4:
             x = torch.split(x, B, dim=0) # [(B, C, H, W)]
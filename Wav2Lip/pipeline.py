@@ -0,0 +1,116 @@
+import threading, queue, time
+
+_DONE = object()
+
+class _Aborted(Exception):
+	pass
+
+class Stage(threading.Thread):
+	"""One pipeline stage running ``fn`` over items from ``inbox`` in its own thread.
+
+	Results go to ``outbox`` (if any). ``busy`` accumulates the time spent inside
+	``fn`` so callers can see which stage bounds the pipeline.
+	"""
+
+	def __init__(self, name, fn, inbox, outbox, abort):
+		super().__init__(name=name, daemon=True)
+		self.fn = fn
+		self.inbox = inbox
+		self.outbox = outbox
+		self.abort = abort
+		self.busy = 0.
+		self.items = 0
+		self.error = None
+
+	def _get(self):
+		while 1:
+			try:
+				return self.inbox.get(timeout=0.1)
+			except queue.Empty:
+				if self.abort.is_set():
+					raise _Aborted()
+
+	def _put(self, item):
+		while 1:
+			try:
+				return self.outbox.put(item, timeout=0.1)
+			except queue.Full:
+				if self.abort.is_set():
+					raise _Aborted()
+
+	def _step(self):
+		item = self._get()
+		if item is _DONE:
+			return False
+		start = time.perf_counter()
+		result = self.fn(item)
+		self.busy += time.perf_counter() - start
+		self.items += 1
+		if self.outbox is not None:
+			self._put(result)
+		return True
+
+	def run(self):
+		try:
+			while self._step():
+				pass
+			if self.outbox is not None:
+				self._put(_DONE)
+		except _Aborted:
+			pass
+		except BaseException as e:
+			self.error = e
+			self.abort.set()
+
+class SourceStage(Stage):
+	"""Pulls items from an iterator; ``busy`` is the time spent producing them."""
+
+	def __init__(self, name, iterable, outbox, abort):
+		super().__init__(name, None, None, outbox, abort)
+		self.iterator = iter(iterable)
+
+	def _step(self):
+		start = time.perf_counter()
+		try:
+			item = next(self.iterator)
+		except StopIteration:
+			return False
+		finally:
+			self.busy += time.perf_counter() - start
+		self.items += 1
+		self._put(item)
+		return True
+
+def run_pipeline(source, stages, maxsize=2, source_name='produce'):
+	"""Runs ``source`` and each ``(name, fn)`` in ``stages`` concurrently.
+
+	Stages are connected by queues holding at most ``maxsize`` items, so memory
+	stays bounded while every stage works on a different item. The first error
+	raised by any stage stops the pipeline and is re-raised here. Returns
+	``(wall_seconds, [(name, busy_seconds, items), ...])``.
+	"""
+	abort = threading.Event()
+	queues = [queue.Queue(maxsize) for _ in stages]
+	threads = [SourceStage(source_name, source, queues[0], abort)]
+	for i, (name, fn) in enumerate(stages):
+		outbox = queues[i + 1] if i + 1 < len(stages) else None
+		threads.append(Stage(name, fn, queues[i], outbox, abort))
+
+	start = time.perf_counter()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	wall = time.perf_counter() - start
+
+	for t in threads:
+		if t.error is not None:
+			raise t.error
+	return wall, [(t.name, t.busy, t.items) for t in threads]
+
+def format_report(wall, stats):
+	lines = ['Pipeline wall time: {:.2f}s'.format(wall)]
+	for name, busy, items in stats:
+		lines.append('  {:<10} busy {:7.2f}s ({:5.1f}%) over {} items'.format(
+			name, busy, 100. * busy / max(wall, 1e-9), items))
+	return '\n'.join(lines)
@@ -5,20 +5,13 @@ if sys.version_info[0] < 3 and sys.version_info[1] < 2:
 
 from os import listdir, path
 
-if not path.isfile('face_detection/detection/sfd/s3fd.pth'):
-	raise FileNotFoundError('Save the s3fd model to face_detection/detection/sfd/s3fd.pth \
-							before running this script!')
-
 import multiprocessing as mp
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import argparse, os, cv2, traceback, subprocess
 from tqdm import tqdm
 from glob import glob
-import audio
-from hparams import hparams as hp
-
-import face_detection
+from smoothing import smooth_boxes
 
 parser = argparse.ArgumentParser()
 
@@ -26,17 +19,18 @@ parser.add_argument('--ngpu', help='Number of GPUs across which to run in parall
 parser.add_argument('--batch_size', help='Single GPU Face detection batch size', default=32, type=int)
 parser.add_argument("--data_root", help="Root folder of the LRS2 dataset", required=True)
 parser.add_argument("--preprocessed_root", help="Root folder of the preprocessed dataset", required=True)
+parser.add_argument('--smoothing', help='Smooth the face boxes of each video over time before cropping',
+					default='none', choices=['none', 'mean', 'ema', 'one_euro'])
 
-args = parser.parse_args()
-
-fa = [face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, 
-									device='cuda:{}'.format(id)) for id in range(args.ngpu)]
+# One face detector per GPU, created by main
+fa = []
 
 template = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'
 # template2 = 'ffmpeg -hide_banner -loglevel panic -threads 1 -y -i {} -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 {}'
 
 def process_video_file(vfile, args, gpu_id):
 	video_stream = cv2.VideoCapture(vfile)
+	fps = video_stream.get(cv2.CAP_PROP_FPS) or 25.
 	
 	frames = []
 	while 1:
@@ -54,17 +48,20 @@ def process_video_file(vfile, args, gpu_id):
 
 	batches = [frames[i:i + args.batch_size] for i in range(0, len(frames), args.batch_size)]
 
-	i = -1
+	preds = []
 	for fb in batches:
-		preds = fa[gpu_id].get_detections_for_batch(np.asarray(fb))
+		preds.extend(fa[gpu_id].get_detections_for_batch(np.asarray(fb)))
 
-		for j, f in enumerate(preds):
-			i += 1
-			if f is None:
-				continue
+	found = [i for i, f in enumerate(preds) if f is not None]
+	if args.smoothing != 'none' and found:
+		params = {'rate': fps} if args.smoothing == 'one_euro' else {}
+		smoothed = smooth_boxes([preds[i] for i in found], args.smoothing, **params).astype(np.int64)
+		for i, box in zip(found, smoothed):
+			preds[i] = tuple(box)
 
-			x1, y1, x2, y2 = f
-			cv2.imwrite(path.join(fulldir, '{}.jpg'.format(i)), fb[j][y1:y2, x1:x2])
+	for i in found:
+		x1, y1, x2, y2 = preds[i]
+		cv2.imwrite(path.join(fulldir, '{}.jpg'.format(i)), frames[i][y1:y2, x1:x2])
 
 def process_audio_file(vfile, args):
 	vidname = os.path.basename(vfile).split('.')[0]
@@ -89,6 +86,14 @@ def mp_handler(job):
 		traceback.print_exc()
 		
 def main(args):
+	if not path.isfile('face_detection/detection/sfd/s3fd.pth'):
+		raise FileNotFoundError('Save the s3fd model to face_detection/detection/sfd/s3fd.pth \
+								before running this script!')
+
+	import face_detection
+
+	fa[:] = [face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, 
+										device='cuda:{}'.format(id)) for id in range(args.ngpu)]
 	print('Started processing for {} with {} GPUs'.format(args.data_root, args.ngpu))
 
 	filelist = glob(path.join(args.data_root, '*/*.mp4'))
@@ -110,4 +115,4 @@ def main(args):
 			continue
 
 if __name__ == '__main__':
-	main(args)
\ No newline at end of file
+	main(parser.parse_args())
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""Post-training INT8 quantization of Wav2Lip and S3FD for CPU inference.
+
+Both networks are quantized with FX graph mode (static, x86 backend) after
+calibrating on frames and audio from a few sample clips, then saved as frozen
+TorchScript files where ``inference.py --precision int8`` looks for them:
+
+	<checkpoint>_int8.ts                                 Wav2Lip
+	face_detection/detection/sfd/s3fd_int8.ts            S3FD
+
+The same clips are then used to report the speedup of each network and its
+drift from fp32: PSNR of the generated face crops and IoU of the detected boxes.
+"""
+import argparse, copy, time
+from itertools import islice
+import numpy as np
+import cv2, torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+import audio, inference
+from models import fuse_model
+
+parser = argparse.ArgumentParser(description='Calibrate and export INT8 Wav2Lip and S3FD models for CPU')
+parser.add_argument('--checkpoint_path', type=str, required=True, help='fp32 Wav2Lip checkpoint')
+parser.add_argument('--calib_videos', nargs='+', type=str, required=True,
+					help='Sample face videos/images used for calibration and evaluation')
+parser.add_argument('--calib_audios', nargs='+', type=str, required=True,
+					help='Audio for each calibration video (a single file is used for all of them)')
+parser.add_argument('--calib_frames', type=int, default=64, help='Frames used from each clip')
+parser.add_argument('--batch_size', type=int, default=16, help='Calibration/evaluation batch size')
+
+class _FrameWav2Lip(torch.nn.Module):
+	"""Wav2Lip.forward restricted to (B, C, H, W) inputs so FX can trace it."""
+	def __init__(self, model):
+		super().__init__()
+		self.model = model
+
+	def forward(self, audio_sequences, face_sequences):
+		return self.model.decode(self.model.encode_audio(audio_sequences), self.model.encode_face(face_sequences))
+
+def s3fd_inputs(frames):
+	"""Same preprocessing as FaceAlignment.get_detections_for_batch + batch_detect."""
+	imgs = np.asarray(frames)[..., ::-1] - np.array([104, 117, 123])
+	return torch.from_numpy(imgs.transpose(0, 3, 1, 2).copy()).float()
+
+def load_clips(args):
+	"""Returns [(frames, wav2lip_batches)] with batches as (mel, face) tensors."""
+	audios = args.calib_audios * len(args.calib_videos) if len(args.calib_audios) == 1 else args.calib_audios
+	if len(audios) != len(args.calib_videos):
+		raise ValueError('Give one --calib_audios file, or one per --calib_videos file')
+
+	clips = []
+	for video, audio_path in zip(args.calib_videos, audios):
+		inference.args = inference.parse_args(['--checkpoint_path', args.checkpoint_path,
+			'--face', video, '--audio', audio_path, '--face_det_batch_size', str(args.batch_size),
+			'--wav2lip_batch_size', str(args.batch_size)])
+
+		if inference.args.static:
+			frames, fps = [cv2.imread(video)], inference.args.fps
+		else:
+			stream = cv2.VideoCapture(video)
+			fps = stream.get(cv2.CAP_PROP_FPS)
+			frames = list(islice(inference.iter_video_frames(stream), args.calib_frames))
+			stream.release()
+
+		mel = audio.melspectrogram(audio.load_wav(audio_path, 16000))
+		mels = inference.get_mel_chunks(mel, fps)[:args.calib_frames]
+		batches = []
+		for img_batch, mel_batch, _, _ in inference.datagen(frames, mels):
+			img_batch, mel_batch = inference.batch_to_tensors(img_batch, mel_batch)
+			batches.append((mel_batch, img_batch))
+		clips.append((frames, batches))
+	return clips
+
+@torch.no_grad()
+def quantize(model, example_inputs, calibration_inputs):
+	prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping('x86'), example_inputs)
+	for inputs in calibration_inputs:
+		prepared(*inputs)
+	quantized = convert_fx(prepared)
+	return torch.jit.freeze(torch.jit.trace(quantized, example_inputs, check_trace=False).eval())
+
+@torch.no_grad()
+def timed(model, inputs):
+	start = time.perf_counter()
+	outputs = [model(*x) for x in inputs]
+	return outputs, time.perf_counter() - start
+
+def psnr(a, b):
+	mse = torch.mean((a - b) ** 2).item()
+	return float('inf') if mse == 0 else 10 * np.log10(1. / mse)
+
+def box_iou(a, b):
+	if a is None or b is None:
+		return float(a is None and b is None)
+	x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+	x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+	inter = max(0, x2 - x1) * max(0, y2 - y1)
+	union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+	return inter / union if union > 0 else 0.
+
+def main(args):
+	torch.backends.quantized.engine = 'x86'
+	if inference.get_device() != 'cpu':
+		raise ValueError('INT8 quantization targets CPU inference; run this on a CPU-only machine')
+
+	clips = load_clips(args)
+	w2l_inputs = [batch for _, batches in clips for batch in batches]
+	frame_batches = [frames[i:i + args.batch_size] for frames, _ in clips
+					for i in range(0, len(frames), args.batch_size)]
+	s3fd_batches = [(s3fd_inputs(frames),) for frames in frame_batches]
+
+	print('Quantizing Wav2Lip...')
+	wav2lip = _FrameWav2Lip(fuse_model(inference.load_model(args.checkpoint_path)))
+	wav2lip_int8 = quantize(wav2lip, w2l_inputs[0], w2l_inputs)
+	wav2lip_path = inference.int8_checkpoint_path(args.checkpoint_path)
+	torch.jit.save(wav2lip_int8, wav2lip_path)
+
+	print('Quantizing S3FD...')
+	detector = inference.get_detector()
+	s3fd = detector.face_detector.face_detector
+	s3fd_int8 = quantize(s3fd, s3fd_batches[0], s3fd_batches)
+	torch.jit.save(s3fd_int8, inference.S3FD_INT8_PATH)
+
+	print('Evaluating against fp32...')
+	ref, t_fp32 = timed(wav2lip, w2l_inputs)
+	out, t_int8 = timed(wav2lip_int8, w2l_inputs)
+	print('Wav2Lip: {:.2f}x faster ({:.2f}s -> {:.2f}s), face PSNR {:.2f} dB'.format(
+		t_fp32 / t_int8, t_fp32, t_int8, np.mean([psnr(a, b) for a, b in zip(ref, out)])))
+
+	start = time.perf_counter()
+	ref = [box for frames in frame_batches for box in detector.get_detections_for_batch(np.asarray(frames))]
+	t_fp32 = time.perf_counter() - start
+	detector.face_detector.face_detector = s3fd_int8
+	start = time.perf_counter()
+	out = [box for frames in frame_batches for box in detector.get_detections_for_batch(np.asarray(frames))]
+	t_int8 = time.perf_counter() - start
+	detector.face_detector.face_detector = s3fd
+	ious = [box_iou(a, b) for a, b in zip(ref, out)]
+	print('S3FD: {:.2f}x faster ({:.2f}s -> {:.2f}s), box IoU mean {:.3f} min {:.3f}'.format(
+		t_fp32 / t_int8, t_fp32, t_int8, np.mean(ious), np.min(ious)))
+
+	print('Saved {} and {}'.format(wav2lip_path, inference.S3FD_INT8_PATH))
+
+if __name__ == '__main__':
+	main(parser.parse_args())
@@ -0,0 +1,227 @@
+"""Long-lived Wav2Lip render service.
+
+The parent process imports inference.py, loads the Wav2Lip checkpoint and the
+S3FD detector once and then forks a pool of workers that inherit the weights
+copy-on-write. That is only done on CPU with the torch backend: CUDA contexts
+and ONNX Runtime thread pools do not survive a fork, so on a GPU or with
+onnxruntime every worker loads its own models after the fork. Workers accept
+jobs on a shared Unix socket, one JSON object per connection, and answer with
+one JSON object:
+
+	request:  {"face": ..., "audio": ..., "outfile": ..., "options": {"pads": [0, 20, 0, 0], ...}}
+	response: {"ok": true, "outfile": ..., "seconds": ...} or {"ok": false, "error": ...}
+
+``options`` may set any inference.py argument by its dest name. Paths should be
+absolute since the server does not share the client's working directory.
+
+With --batch_jobs, Wav2Lip runs in one more forked process instead of in every
+worker: a batch_scheduler.BatchScheduler that merges the batches of concurrent
+jobs into full batches. Workers then only decode, detect faces and composite.
+The precision and backend of that model are fixed by the server options.
+"""
+import os, io, sys, json, socket, signal, shutil, tempfile, time, traceback, argparse, contextlib, gc
+
+parser = argparse.ArgumentParser(description='Persistent Wav2Lip render service')
+parser.add_argument('--checkpoint_path', type=str, required=True,
+					help='Wav2Lip checkpoint kept resident in every worker')
+parser.add_argument('--socket', type=str, default='/tmp/wav2lip.sock',
+					help='Unix socket path to listen on')
+parser.add_argument('--workers', type=int, default=2, help='Number of preforked render workers')
+parser.add_argument('--threads_per_worker', type=int, default=0,
+					help='torch intra-op threads per worker (default: cores / workers)')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'int8'],
+					help='Precision of the models kept resident (jobs may override it)')
+parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnxruntime'],
+					help='Runtime of the models kept resident (jobs may override it); workers import torch either way')
+parser.add_argument('--batch_jobs', action='store_true',
+					help='Run Wav2Lip for all workers in a shared scheduler that merges their batches')
+parser.add_argument('--max_batch', type=int, default=128, help='Rows per merged batch with --batch_jobs')
+parser.add_argument('--max_wait_ms', type=float, default=20,
+					help='Longest wait for a merged batch to fill up with --batch_jobs')
+parser.add_argument('--temp_root', type=str, default='temp',
+					help='Parent directory for per-job temporary directories')
+
+def render(job, socket_path='/tmp/wav2lip.sock', timeout=None):
+	"""Submits one job to a running server and returns its response dict."""
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+		conn.settimeout(timeout)
+		conn.connect(socket_path)
+		conn.sendall((json.dumps(job) + '\n').encode('utf-8'))
+		conn.shutdown(socket.SHUT_WR)
+		return json.loads(_recv_all(conn).decode('utf-8'))
+
+def _recv_all(conn):
+	chunks = []
+	while 1:
+		chunk = conn.recv(65536)
+		if not chunk:
+			break
+		chunks.append(chunk)
+	return b''.join(chunks)
+
+def _job_args(job, server_args, temp_dir):
+	import inference
+
+	argv = ['--checkpoint_path', server_args.checkpoint_path,
+			'--face', job['face'], '--audio', job['audio'], '--temp_dir', temp_dir,
+			'--precision', server_args.precision, '--backend', server_args.backend]
+	if job.get('outfile'):
+		argv += ['--outfile', job['outfile']]
+
+	# Options go through the parser too, so they get its types and choices.
+	actions = {action.dest: action for action in inference.parser._actions if action.option_strings}
+	for k, v in job.get('options', {}).items():
+		if k in ('checkpoint_path', 'temp_dir', 'help') or k not in actions:
+			raise ValueError('Unsupported option: {}'.format(k))
+		argv += _option_argv(actions[k], v)
+
+	errors = io.StringIO()
+	try:
+		with contextlib.redirect_stderr(errors):
+			return inference.parse_args(argv)
+	except SystemExit:
+		raise ValueError(errors.getvalue().strip().splitlines()[-1].split('error: ', 1)[-1])
+
+def _option_argv(action, value):
+	flag = action.option_strings[-1]
+	if action.nargs == 0:
+		# store_true / store_false
+		if not isinstance(value, bool):
+			raise ValueError('Option {} takes true or false'.format(action.dest))
+		return [flag] if value != action.default else []
+	if action.type is bool:
+		# --static is parsed with bool(), which is only false for ''
+		return [flag, '1' if value else '']
+	values = value if isinstance(value, (list, tuple)) else [value]
+	return [flag] + [str(v) for v in values]
+
+def _handle(conn, server_args):
+	import inference
+
+	start = time.time()
+	temp_dir = tempfile.mkdtemp(prefix='job_', dir=server_args.temp_root)
+	try:
+		job = json.loads(_recv_all(conn).decode('utf-8'))
+		inference.args = _job_args(job, server_args, temp_dir)
+		inference.main()
+		response = {'ok': True, 'outfile': inference.args.outfile, 'seconds': time.time() - start}
+	except Exception as e:
+		traceback.print_exc()
+		response = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+	finally:
+		shutil.rmtree(temp_dir, ignore_errors=True)
+
+	try:
+		conn.sendall(json.dumps(response).encode('utf-8'))
+	except OSError:
+		pass
+
+def _worker(sock, server_args):
+	import torch
+
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	signal.signal(signal.SIGINT, signal.SIG_DFL)
+	threads = server_args.threads_per_worker or max(1, (os.cpu_count() or 1) // server_args.workers)
+	torch.set_num_threads(threads)
+	# With --batch_jobs, Wav2Lip runs in the scheduler; workers only need S3FD.
+	if not _preload(server_args):
+		_load_models(server_args, wav2lip=not server_args.batch_jobs)
+	if server_args.batch_jobs:
+		import inference
+		from batch_scheduler import SchedulerClient
+		inference.shared_model = SchedulerClient(_scheduler_address(server_args))
+
+	while 1:
+		conn, _ = sock.accept()
+		with conn:
+			_handle(conn, server_args)
+
+def _scheduler_address(server_args):
+	return server_args.socket + '.batch'
+
+def _scheduler(server_args):
+	import torch, inference
+	from batch_scheduler import serve_batches
+
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	signal.signal(signal.SIGINT, signal.SIG_DFL)
+	if server_args.threads_per_worker:
+		torch.set_num_threads(server_args.threads_per_worker)
+	model = inference.get_model(server_args.checkpoint_path, server_args.precision, server_args.backend)
+
+	address = _scheduler_address(server_args)
+	if os.path.exists(address):
+		os.remove(address)
+	serve_batches(model, address, inference.get_device(), server_args.max_batch, server_args.max_wait_ms / 1000.)
+
+def _spawn(target, *args):
+	pid = os.fork()
+	if pid == 0:
+		try:
+			target(*args)
+		finally:
+			os._exit(1)
+	return pid
+
+def _preload(server_args):
+	"""Whether the parent loads the models before forking the workers."""
+	import inference
+
+	# torch.cuda.is_available() does not create a CUDA context, so the check
+	# itself is safe before a fork.
+	return server_args.backend != 'onnxruntime' and inference.get_device() == 'cpu'
+
+def _load_models(server_args, wav2lip=True):
+	import inference
+
+	if wav2lip:
+		inference.get_model(server_args.checkpoint_path, server_args.precision, server_args.backend)
+	inference.get_detector(server_args.precision, server_args.backend)
+
+def serve(server_args):
+	os.makedirs(server_args.temp_root, exist_ok=True)
+
+	# Load everything before forking so the weights are shared copy-on-write,
+	# unless the workers have to load their own (see _preload).
+	if _preload(server_args):
+		_load_models(server_args)
+	gc.collect()
+	gc.freeze()
+
+	if os.path.exists(server_args.socket):
+		os.remove(server_args.socket)
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.bind(server_args.socket)
+	sock.listen(64)
+
+	scheduler = _spawn(_scheduler, server_args) if server_args.batch_jobs else None
+	workers = set(_spawn(_worker, sock, server_args) for _ in range(server_args.workers))
+	print('Serving on {} with {} workers'.format(server_args.socket, len(workers)))
+
+	def shutdown(signum, frame):
+		for pid in workers | {scheduler} - {None}:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+		sock.close()
+		for path in (server_args.socket, _scheduler_address(server_args)):
+			if os.path.exists(path):
+				os.remove(path)
+		sys.exit(0)
+
+	signal.signal(signal.SIGTERM, shutdown)
+	signal.signal(signal.SIGINT, shutdown)
+
+	while 1:
+		pid, status = os.wait()
+		if pid in workers:
+			workers.remove(pid)
+			print('Worker {} exited with status {}, respawning'.format(pid, status))
+			workers.add(_spawn(_worker, sock, server_args))
+		elif pid == scheduler:
+			print('Batch scheduler {} exited with status {}, respawning'.format(pid, status))
+			scheduler = _spawn(_scheduler, server_args)
+
+if __name__ == '__main__':
+	serve(parser.parse_args())
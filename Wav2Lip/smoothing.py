@@ -0,0 +1,95 @@
+"""Temporal smoothing of per-frame face boxes.
+
+Boxes are (N, 4) arrays with one row per frame. All filters take linear time in
+N: the moving average uses cumulative sums, the exponential filter runs as a
+first-order IIR filter in scipy, and the one-euro filter, whose gain depends
+on its own output, steps through the frames once.
+
+The exponential and one-euro filters are causal and keep their state between
+calls, so a sequence can be smoothed in chunks. The moving average looks
+``lookahead`` frames ahead and always smooths a whole sequence.
+"""
+import math
+import numpy as np
+
+class MovingAverage:
+	"""Mean of each box and the ``window - 1`` boxes after it. The last
+	``window - 1`` boxes share the final window."""
+
+	def __init__(self, window=5):
+		self.window = window
+		self.lookahead = window - 1
+
+	def __call__(self, boxes):
+		boxes = np.asarray(boxes, dtype=np.float64)
+		n = len(boxes)
+		if n == 0:
+			return boxes.copy()
+		window = min(self.window, n)
+		sums = np.concatenate([np.zeros((1,) + boxes.shape[1:]), np.cumsum(boxes, axis=0)])
+		starts = np.minimum(np.arange(n), n - window)
+		return (sums[starts + window] - sums[starts]) / window
+
+class Exponential:
+	"""y[i] = alpha * x[i] + (1 - alpha) * y[i - 1], starting at the first box."""
+
+	lookahead = 0
+
+	def __init__(self, alpha=0.5):
+		self.alpha = alpha
+		self.last = None
+
+	def __call__(self, boxes):
+		from scipy.signal import lfilter    # slow to import; most renders use the mean
+
+		boxes = np.asarray(boxes, dtype=np.float64)
+		if len(boxes) == 0:
+			return boxes.copy()
+		last = boxes[0] if self.last is None else self.last
+		out, _ = lfilter([self.alpha], [1., self.alpha - 1.], boxes, axis=0,
+						zi=((1. - self.alpha) * last)[None])
+		self.last = out[-1]
+		return out
+
+class OneEuro:
+	"""One-euro filter (Casiez et al., CHI 2012): an exponential filter whose
+	cutoff frequency rises with the box speed, so that slow jitter is smoothed
+	strongly while fast head motion is followed with little lag. ``rate`` is the
+	frame rate; cutoffs are in Hz and ``beta`` is per pixel/second."""
+
+	lookahead = 0
+
+	def __init__(self, rate=25., min_cutoff=1., beta=0.01, d_cutoff=1.):
+		self.rate = rate
+		self.min_cutoff = min_cutoff
+		self.beta = beta
+		self.d_cutoff = d_cutoff
+		self.last = None
+		self.speed = None
+
+	def __call__(self, boxes):
+		boxes = np.asarray(boxes, dtype=np.float64)
+		if len(boxes) == 0:
+			return boxes.copy()
+		if self.last is None:
+			self.last, self.speed = boxes[0].tolist(), [0.] * boxes.shape[1]
+
+		# Plain floats: per-frame numpy calls on 4-element rows would dominate.
+		rate, beta, min_cutoff = self.rate, self.beta, self.min_cutoff
+		k = rate / (2 * math.pi)
+		alpha_d = 1. / (1. + k / self.d_cutoff)
+		last, speed = self.last, self.speed
+		out = []
+		for row in boxes.tolist():
+			for c, x in enumerate(row):
+				speed[c] = alpha_d * (x - last[c]) * rate + (1. - alpha_d) * speed[c]
+				alpha = 1. / (1. + k / (min_cutoff + beta * abs(speed[c])))
+				last[c] = alpha * x + (1. - alpha) * last[c]
+			out.append(list(last))
+		return np.array(out)
+
+SMOOTHERS = {'mean': MovingAverage, 'ema': Exponential, 'one_euro': OneEuro}
+
+def smooth_boxes(boxes, method='mean', **params):
+	"""Smooths a whole (N, 4) sequence of boxes with a fresh filter."""
+	return SMOOTHERS[method](**params)(boxes)
@@ -0,0 +1,73 @@
+"""Measures how long the Wav2Lip entry points take to import and checks them
+against a startup budget.
+
+Each module is imported in a fresh interpreter with ``python -X importtime``; its
+cumulative import time (the best of --repeats runs) must stay within its budget
+in BUDGETS_MS, and none of the heavy modules in DEFERRED may be imported at that
+point: they belong in the functions that need them. The slowest imports of each
+module are listed to show where the time goes. Exits with status 1 if any module
+is over budget.
+
+	python startup_benchmark.py
+	python -X importtime -c "import inference" 2> imports.txt   # the raw data
+"""
+import argparse, os, subprocess, sys
+
+# Budgets in ms, on top of the interpreter's own startup. numpy and cv2 are
+# allowed; torch alone takes seconds.
+BUDGETS_MS = {
+	'inference': 500,
+	'render_server': 100,
+	'preprocess': 500,
+}
+
+DEFERRED = ['torch', 'librosa', 'scipy', 'face_detection', 'models', 'onnxruntime']
+
+parser = argparse.ArgumentParser(description='Check the import time of the Wav2Lip entry points')
+parser.add_argument('--modules', nargs='+', default=sorted(BUDGETS_MS), help='Modules to import')
+parser.add_argument('--repeats', type=int, default=3, help='Imports per module; the fastest counts')
+parser.add_argument('--top', type=int, default=5, help='Slowest imports to list per module')
+parser.add_argument('--scale', type=float, default=1.,
+					help='Multiplies every budget, e.g. for slow machines')
+
+def import_times(module):
+	"""Imports ``module`` in a new interpreter. Returns {name: (self us, cumulative us)}
+	of everything it imported, and its own cumulative time in us."""
+	here = os.path.dirname(os.path.abspath(__file__))
+	result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+							cwd=here, capture_output=True, text=True)
+	if result.returncode != 0:
+		raise RuntimeError('import {} failed:\n{}'.format(module, result.stderr))
+
+	times, total = {}, None
+	for line in result.stderr.splitlines():
+		if not line.startswith('import time:') or 'self [us]' in line:
+			continue
+		self_us, cumulative_us, name = line[len('import time:'):].split('|')
+		times[name.strip()] = (int(self_us), int(cumulative_us))
+		if name.strip() == module and not name.startswith(' ' * 2):
+			total = int(cumulative_us)
+	return times, total
+
+def check(module, repeats, top, budget_ms):
+	runs = [import_times(module) for _ in range(repeats)]
+	times, total = min(runs, key=lambda run: run[1])
+	deferred = sorted(name for name in times if name.split('.')[0] in DEFERRED)
+
+	ok = total / 1000. <= budget_ms and not deferred
+	print('{:<16} {:>8.1f}ms (budget {:.0f}ms) {}'.format(module, total / 1000., budget_ms, 'ok' if ok else 'OVER'))
+	slowest = sorted((self_us, name) for name, (self_us, _) in times.items() if name != module)[::-1][:top]
+	for self_us, name in slowest:
+		print('    {:>8.1f}ms  {}'.format(self_us / 1000., name))
+	if deferred:
+		print('    imports modules that should be deferred: {}'.format(', '.join(deferred[:10])))
+	return ok
+
+def main(args):
+	ok = True
+	for module in args.modules:
+		ok &= check(module, args.repeats, args.top, BUDGETS_MS.get(module, 500) * args.scale)
+	sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+	main(parser.parse_args())
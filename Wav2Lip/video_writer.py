@@ -0,0 +1,67 @@
+import os, subprocess, tempfile
+import numpy as np
+
+class FFmpegWriter:
+	"""Drop-in replacement for cv2.VideoWriter that streams raw BGR frames to a
+	single ffmpeg process over stdin and muxes ``audio_path`` in the same pass,
+	so the result is encoded once and never round-trips through a temp file.
+	"""
+
+	def __init__(self, path, fps, size, audio_path=None, vcodec='libx264', preset='medium',
+				crf=18, threads=0, ffmpeg='ffmpeg'):
+		width, height = size
+		command = [ffmpeg, '-y', '-loglevel', 'error',
+					'-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(width, height),
+					'-r', str(fps), '-i', '-']
+		if audio_path is not None:
+			command += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0', '-c:a', 'aac']
+
+		# yuv420p needs even dimensions
+		command += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', vcodec, '-pix_fmt', 'yuv420p']
+		if preset:
+			command += ['-preset', preset]
+		if crf is not None:
+			command += ['-crf', str(crf)]
+		command += ['-threads', str(threads), '-strict', '-2', path]
+
+		self.path = path
+		self.frame_shape = (height, width, 3)
+		self._log = tempfile.TemporaryFile()
+		self._proc = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self._log)
+
+	def _error(self):
+		self._log.seek(0)
+		return self._log.read().decode('utf-8', 'replace').strip()
+
+	def write(self, frame):
+		if frame.shape != self.frame_shape:
+			raise ValueError('Frame shape {} does not match writer shape {}'.format(frame.shape, self.frame_shape))
+		try:
+			self._proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+		except BrokenPipeError:
+			self._proc.wait()
+			raise RuntimeError('ffmpeg exited while encoding: {}'.format(self._error()))
+
+	def release(self):
+		if self._proc.stdin.closed:
+			return
+		try:
+			self._proc.stdin.close()
+		except BrokenPipeError:
+			pass
+		if self._proc.wait() != 0:
+			raise RuntimeError('ffmpeg failed with exit code {}: {}'.format(self._proc.returncode, self._error()))
+		self._log.close()
+
+	def abort(self):
+		"""Kills ffmpeg without finishing the file and removes the partial output."""
+		if self._proc.poll() is None:
+			self._proc.kill()
+		self._proc.wait()
+		try:
+			self._proc.stdin.close()
+		except OSError:
+			pass
+		self._log.close()
+		if os.path.exists(self.path):
+			os.remove(self.path)